@@ -2,6 +2,7 @@
 from abc import ABC, abstractmethod
 
 from phon_utility.save_and_load import BatchSaver
+from tqdm import tqdm
 import numpy as np
 
 class BatchExtractor(ABC):
@@ -16,6 +17,18 @@ class BatchExtractor(ABC):
         def _extract_batch_embeddings_as_dict():
             pass
 
+    # Responsability: embeds a list of sentences, with a single padded forward pass when the model supports it.
+    # With layers, every embedding is a dictionary {layer: embedding} (transformer models only).
+    @staticmethod
+    def _embed_sentences(model, sentences, layers=None):
+        if layers is not None:
+            if not hasattr(model, '_resolve_layers'):
+                raise ValueError(f"Layer selection is not supported by {model.__class__.__name__}.")
+            return model.embed_batch(sentences, layers=layers)
+        if hasattr(model, 'embed_batch'):
+            return model.embed_batch(sentences)
+        return [model.embed(sentence) for sentence in sentences]
+
 class TrainingBatch:
     def __init__(self) -> None:
         self.batch = []
@@ -54,18 +67,17 @@ class TrainingBatch:
 
         
 class BatchPhoneticEmbsExtractor(BatchExtractor):
-    def __init__(self, phonetic_model, output_file, batch_size):
+    def __init__(self, phonetic_model, output_file, batch_size, layers=None):
         self.phonetic_model = phonetic_model
         self.extracted_embeddings = []
         self.output_file = output_file
         self.batch_size = batch_size
+        self.layers = layers
 
     # Responsability: after the phonetic transcript extraction, it eventually handles embeddings extractin, batch per batch.
     def _extract_batch_embeddings(self, i, batch_size, batch):
-        for item in batch:
-            sentence = item if item is not None else 'ə'
-            embeddings = self.phonetic_model.embed(sentence)
-            self.extracted_embeddings.append(embeddings)
+        sentences = [item if item is not None else 'ə' for item in batch]
+        self.extracted_embeddings.extend(self._embed_sentences(self.phonetic_model, sentences, self.layers))
 
         if i % batch_size == 0:
             BatchSaver().save_batch(self.extracted_embeddings, self.output_file, i // self.batch_size)
@@ -83,28 +95,46 @@ class BatchPhoneticEmbsExtractor(BatchExtractor):
         else:
             return False  
     
-    def model_embed_multi_words(self, item):
-        embs = []
-        for element in item.split():
-            embeddings = self.phonetic_model.embed(element)
-            embs.append(embeddings)
+    @staticmethod
+    def _average_words(embs):
         embs = [emb for emb in embs if str(emb) != 'nan']
         embs = sum(embs) / len(embs)
         return embs
 
-    def _extract_batch_embeddings_as_dict(self, i, batch_size, batch):
+    def model_embed_multi_words(self, item):
+        return self._average_words(self._embed_sentences(self.phonetic_model, item.split()))
+
+    def _embed_batch_as_dict(self, batch):
         # If it's a contextual model, we will extract the "sentence" embeddings"
         is_a_contextual_model = self.check_if_contextual_model()
         embs_dict = {}
+        single_items = []
+        multi_items = []
         for item in batch:
             sentence = item[1] if item[1] is not None else 'ə'
+            # Placeholder to keep the batch order; filled after the (batched) forward passes
+            embs_dict[item[0]] = None
             if self.check_if_multi_words(sentence) and is_a_contextual_model == False:
-                embeddings = self.model_embed_multi_words(sentence)
-                embs_dict[item[0]] = embeddings
+                multi_items.append((item[0], sentence.split()))
             else:
-                embeddings = self.phonetic_model.embed(sentence)
-                embs_dict[item[0]] = embeddings
+                single_items.append((item[0], sentence))
+
+        embeddings = self._embed_sentences(self.phonetic_model, [sentence for _, sentence in single_items], self.layers)
+        for (key, _), embedding in zip(single_items, embeddings):
+            embs_dict[key] = embedding
+
+        # The words of all the multi-word items are embedded together, then averaged item by item
+        if not multi_items:
+            return embs_dict
+        embeddings = self._embed_sentences(self.phonetic_model, [word for _, words in multi_items for word in words])
+        start = 0
+        for key, words in multi_items:
+            embs_dict[key] = self._average_words(embeddings[start:start + len(words)])
+            start += len(words)
+        return embs_dict
 
+    def _extract_batch_embeddings_as_dict(self, i, batch_size, batch):
+        embs_dict = self._embed_batch_as_dict(batch)
         self.extracted_embeddings.append(embs_dict)
 
         if i % batch_size == 0:
@@ -113,18 +143,17 @@ class BatchPhoneticEmbsExtractor(BatchExtractor):
             self.extracted_embeddings = []  
 
 class BatchEmbsExtractor(BatchExtractor):
-    def __init__(self, model, output_file, batch_size):
+    def __init__(self, model, output_file, batch_size, layers=None):
         self.model = model
         self.extracted_embeddings = []
         self.output_file = output_file
         self.batch_size = batch_size
+        self.layers = layers
 
     # Responsability: after the phonetic transcript extraction, it eventually handles embeddings extractin, batch per batch.
     def _extract_batch_embeddings(self, i, batch_size, batch):
-        for item in batch:
-            sentence = item if item is not None else 'ə'
-            embeddings = self.model.embed(sentence)
-            self.extracted_embeddings.append(embeddings)
+        sentences = [item if item is not None else 'ə' for item in batch]
+        self.extracted_embeddings.extend(self._embed_sentences(self.model, sentences, self.layers))
 
         if i % batch_size == 0:
             BatchSaver().save_batch(self.extracted_embeddings, self.output_file, i // self.batch_size)
@@ -150,19 +179,28 @@ class BatchEmbsExtractor(BatchExtractor):
         embs = sum(embs) / len(embs)
         return embs
         
-    def _extract_batch_embeddings_as_dict(self, i, batch_size, batch):
+    def _embed_batch_as_dict(self, batch):
         # If it's a contextual model, we will extract the "sentence" embeddings"
         is_a_contextual_model = self.check_if_contextual_model()
         embs_dict = {}
+        single_items = []
         for item in batch:
             sentence = item[1] if item[1] is not None and str(item[1]) != 'nan' else 'ə'
             if self.check_if_multi_words(sentence) and is_a_contextual_model == False:
                 embeddings = self.model_embed_multi_words(sentence)
                 embs_dict[item[0]] = embeddings
             else:
-                embeddings = self.model.embed(sentence)
-                embs_dict[item[0]] = embeddings
+                # Placeholder to keep the batch order; filled after the (batched) forward pass
+                embs_dict[item[0]] = None
+                single_items.append((item[0], sentence))
 
+        embeddings = self._embed_sentences(self.model, [sentence for _, sentence in single_items], self.layers)
+        for (key, _), embedding in zip(single_items, embeddings):
+            embs_dict[key] = embedding
+        return embs_dict
+
+    def _extract_batch_embeddings_as_dict(self, i, batch_size, batch):
+        embs_dict = self._embed_batch_as_dict(batch)
         self.extracted_embeddings.append(embs_dict)
 
         if i % batch_size == 0:
@@ -171,4 +209,111 @@ class BatchEmbsExtractor(BatchExtractor):
             self.extracted_embeddings = []  
 
 
+class LengthBucketScheduler:
+    """
+    Schedules contextual extraction jobs so that little compute is wasted on padding.
+    Jobs are sorted by tokenized length and grouped in batches whose padded size
+    (rows * longest row) stays under a token budget, instead of using a fixed number of rows.
+    """
+    def __init__(self, tokenizer, max_batch_tokens=8192, max_length=512, packed=False, all_occurrences=False, stride=None):
+        self.tokenizer = tokenizer
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        # With packing, short sentences share rows: a batch costs its real tokens, not rows * longest row
+        self.packed = packed
+        # Every occurrence of the target is read, long passages through strided windows (see embed_all_occurrences_batch)
+        self.all_occurrences = all_occurrences
+        self.stride = stride
+
+    def _token_lengths(self, sentences):
+        if len(sentences) == 0:
+            return []
+        if self.all_occurrences:
+            # Long passages are not truncated but split into windows: their whole length counts
+            input_ids = self.tokenizer(sentences)['input_ids']
+        else:
+            input_ids = self.tokenizer(sentences, truncation=True, max_length=self.max_length)['input_ids']
+        return [len(ids) for ids in input_ids]
+
+    def _window_rows(self, length):
+        # Rows encoded for a passage of length tokens by embed_all_occurrences_batch: one per strided window
+        # (as in TransformerEmbeddings._strided_windows), at most max_length tokens each
+        n_special = self.tokenizer.num_special_tokens_to_add()
+        window_length = self.max_length - n_special
+        n_tokens = length - n_special
+        if n_tokens <= window_length:
+            return 1, length
+        stride = self.stride if self.stride is not None else max(1, window_length // 2)
+        return len(range(0, n_tokens - window_length, stride)) + 1, self.max_length
 
+    # Responsability: returns the batches as lists of job indices, shortest sentences first.
+    def schedule(self, sentences):
+        lengths = self._token_lengths(sentences)
+        # (rows, row length) of every sentence; only long all_occurrences passages take several rows
+        shapes = [self._window_rows(length) if self.all_occurrences else (1, length) for length in lengths]
+        order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+        batches = []
+        current_batch, current_max_length, current_rows, current_tokens = [], 0, 0, 0
+        for i in order:
+            rows, row_length = shapes[i]
+            new_max_length = max(current_max_length, row_length)
+            # Packed rows cost their real tokens, padded rows rows * longest row
+            cost = current_tokens + lengths[i] if self.packed and not self.all_occurrences else new_max_length * (current_rows + rows)
+            if current_batch and cost > self.max_batch_tokens:
+                batches.append(current_batch)
+                current_batch, new_max_length, current_rows, current_tokens = [], row_length, 0, 0
+            current_batch.append(i)
+            current_max_length = new_max_length
+            current_rows += rows
+            current_tokens += lengths[i]
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def run(self, model, jobs, layers=None):
+        """
+        Extracts the contextual embeddings for all the jobs. Jobs sharing the same sentence are encoded
+        with a single forward pass, and all their target spans are read from the same hidden states.
+
+        :param model: Model exposing embed_targets_from_sentence_batch (ClassicBERT, XPhoneBERT, also behind CachedEmbeddings).
+        :param jobs: List of (key, sentence, target_word) tuples.
+        :param layers: Optional layer selection, forwarded to the model.
+        :return: Dictionary {key: [embeddings]} with the embeddings of every key in the original job order.
+        """
+        if self.all_occurrences:
+            return self._run_all_occurrences(model, jobs, layers)
+
+        # Unique sentences, each one with the jobs (and target words) it serves
+        jobs_by_sentence = {}
+        for i, (_, sentence, _) in enumerate(jobs):
+            jobs_by_sentence.setdefault(sentence, []).append(i)
+        sentences = list(jobs_by_sentence.keys())
+
+        embeddings = [None] * len(jobs)
+        batches = self.schedule(sentences)
+        for batch in tqdm(batches, desc="Processing length buckets"):
+            items = [(sentences[i], [jobs[j][2] for j in jobs_by_sentence[sentences[i]]]) for i in batch]
+            if self.packed:
+                targets = model.embed_targets_from_sentence_batch(items, max_length=self.max_length, layers=layers, packed=True)
+            else:
+                targets = model.embed_targets_from_sentence_batch(items, max_length=self.max_length, layers=layers)
+            for i, sentence_targets in zip(batch, targets):
+                for j, embedding in zip(jobs_by_sentence[sentences[i]], sentence_targets):
+                    embeddings[j] = embedding
+
+        embs_dict = {}
+        for (key, _, _), embedding in zip(jobs, embeddings):
+            embs_dict.setdefault(key, []).append(embedding)
+        return embs_dict
+
+    def _run_all_occurrences(self, model, jobs, layers=None):
+        embeddings = [None] * len(jobs)
+        for batch in tqdm(self.schedule([sentence for _, sentence, _ in jobs]), desc="Processing length buckets"):
+            pairs = [(jobs[i][1], jobs[i][2]) for i in batch]
+            for i, embedding in zip(batch, model.embed_all_occurrences_batch(pairs, max_length=self.max_length, stride=self.stride, layers=layers)):
+                embeddings[i] = embedding
+
+        embs_dict = {}
+        for (key, _, _), embedding in zip(jobs, embeddings):
+            embs_dict.setdefault(key, []).append(embedding)
+        return embs_dict
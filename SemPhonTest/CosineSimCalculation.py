@@ -2,10 +2,11 @@ from abc import ABC, abstractmethod
 from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
 import torch    
-import time
 import warnings
 import numpy as np
 import logging
+from embeddings.embedding_matrix import EmbeddingMatrix
+from SemPhonTest.SimilarityMetrics import get_metric
 
 logging.basicConfig(
     filename='log.txt',
@@ -86,12 +87,9 @@ class CosineAnchorTest(Calculator):
                 comparison_element = elements[n_comparison_element]
                 if comparison_element not in list_of_existing_embs:
                     cosine_sim = {comparison_element: 'absent'}
-                    print(comparison_element)
                     warnings.warn("You are missing the embeddings. Are you sure this is not a bug?")
-                    time.sleep(5)
                     # If the triplet[0] is absent, it's not useful to continue with this triplet 
                     if n_comparison_element == 0:
-                        print(comparison_element)
                         warnings.warn("the anchor and its embedding is missing. Are you sure this is not a bug?")
                         for len_needed_for_format in range(3):
                             cosines_of_the_triplet.append(cosine_sim)
@@ -100,9 +98,7 @@ class CosineAnchorTest(Calculator):
                     anchor = trained_embs[elements[0]]
                     embs_of_comparison_element = trained_embs[comparison_element]
                     if str(embs_of_comparison_element) == 'nan' or str(anchor) == 'nan':
-                        print(comparison_element)
                         warnings.warn("You are missing the embeddings. Are you sure this is not a bug?")
-                        time.sleep(5)
                         break
                     cosine_sim = {comparison_element: cosine_calculator.calc(anchor, embs_of_comparison_element)}
                 cosines_of_the_triplet.append(cosine_sim)
@@ -123,6 +119,138 @@ class CosineAnchorTest(Calculator):
 
         return df
 
+MISSING_POLICIES = ('skip', 'zero', 'fail')
+
+class VectorizedCosineAnchorTest(Calculator):
+    """
+    CosineAnchorTest on an aligned embedding matrix. The embeddings dictionary is converted once into a
+    float32 matrix plus a key index, the dataset columns into row indices, and every anchor-vs-candidate
+    similarity comes from a gathered row-wise operation.
+    The metric is any entry of SimilarityMetrics.SIMILARITY_METRICS (cosine by default); each metric prepares
+    the aligned matrix once, so a multi-metric sweep never converts the embeddings again.
+    With cosine, calc returns the DataFrame of CosineAnchorTest._to_pandas(CosineAnchorTest.calc(...)) (scores equal up to float32 rounding).
+    """
+    def __init__(self, trained_embs) -> None:
+        super().__init__()
+        embedding_matrix = EmbeddingMatrix.from_dict(trained_embs)
+        # NaN values inside the embeddings become 0, as in CosineSim._format_handler
+        np.nan_to_num(embedding_matrix.matrix, copy=False)
+        self.embeddings = embedding_matrix
+        self.key_index = pd.Index(embedding_matrix.keys)
+        # One extra row at the end of every prepared matrix: the missing words (index -1) are gathered from it
+        self.zero_row = len(embedding_matrix.keys)
+        self.present = np.append(embedding_matrix.present, False)
+        # 'EXCLUDED' placeholders (CombinedModelsFromDict) are filtered out; the nan ones truncate the row as in CosineAnchorTest
+        self.excluded = np.append(np.array([isinstance(trained_embs[key], str) for key in embedding_matrix.keys], dtype=bool), False)
+        self.missing_report = pd.DataFrame()
+        self._prepared = {}
+
+    def prepared(self, metric='cosine'):
+        # The aligned matrix as the metric needs it, computed once per metric
+        if metric not in self._prepared:
+            matrix = get_metric(metric).prepare(self.embeddings.matrix)
+            self._prepared[metric] = np.vstack([matrix, np.zeros((1, self.embeddings.dimension), dtype=matrix.dtype)])
+        return self._prepared[metric]
+
+    def rows(self, dataset):
+        """
+        :return: Array (n quartets, n columns) of matrix rows, -1 for the words without embeddings.
+        """
+        return np.stack([self.key_index.get_indexer(dataset[column]) for column in dataset.columns], axis=1)
+
+    def scores(self, rows, metric='cosine'):
+        matrix, rowwise = self.prepared(metric), get_metric(metric).rowwise
+        anchors = matrix[rows[:, 0]]
+        return np.stack([rowwise(matrix[rows[:, j]], anchors) for j in range(rows.shape[1])], axis=1).astype(np.float64)
+
+    def _missing_reasons(self, rows):
+        # 'missing': the word is not an embedding key; 'nan': its embedding is a nan placeholder
+        reasons = np.full(rows.shape, '', dtype=object)
+        reasons[rows == -1] = 'missing'
+        reasons[(rows != -1) & ~self.present[rows] & ~self.excluded[rows]] = 'nan'
+        return reasons
+
+    def missing_embeddings(self, dataset, reasons=None):
+        """
+        Resolves the dataset cells without a usable embedding: words missing from the embeddings
+        (set difference between dataset and embedding keys) and nan placeholders.
+
+        :return: DataFrame with one line per affected cell: dataset row, column, word, reason and the whole quartet.
+        """
+        reasons = self._missing_reasons(self.rows(dataset)) if reasons is None else reasons
+        cell_rows, cell_columns = np.nonzero(reasons != '')
+        report = dataset.iloc[cell_rows].reset_index().rename(columns={'index': 'row'})
+        report.insert(1, 'column', dataset.columns[cell_columns])
+        report.insert(2, 'word', dataset.to_numpy(dtype=object)[cell_rows, cell_columns])
+        report.insert(3, 'reason', reasons[cell_rows, cell_columns])
+        return report
+
+    def calc(self, dataset: pd.DataFrame, columns=None, missing_policy=None, metric='cosine', missing_report=None):
+        """
+        :param dataset: PSET dataset, the anchor in the first column.
+        :param columns: Output columns, as in CosineAnchorTest._to_pandas; defaults to [a, a_score, b, b_score, ...].
+        :param missing_policy: What to do with the words without embeddings (missing or nan), resolved before any cosine:
+            'skip' drops their quartets, 'zero' gives them a zero vector (cosine 0), 'fail' raises KeyError.
+            None keeps the CosineAnchorTest layout ('absent' cells, rows truncated at nan embeddings).
+            The affected cells are stored in self.missing_report.
+        :param metric: Name of the similarity metric (SimilarityMetrics.SIMILARITY_METRICS).
+        :param missing_report: Result of missing_embeddings(dataset), if already computed.
+        :return: DataFrame with one (word, score) pair of columns per dataset column.
+        """
+        if missing_policy not in MISSING_POLICIES + (None,):
+            raise ValueError(f"Unknown missing_policy {missing_policy}: choose one of {MISSING_POLICIES}.")
+        if columns is None:
+            columns = [name for column in dataset.columns for name in (column, f'{column}_score')]
+        rows = self.rows(dataset)
+        reasons = self._missing_reasons(rows)
+        self.missing_report = self.missing_embeddings(dataset, reasons) if missing_report is None else missing_report
+        if len(self.missing_report):
+            missing_words = pd.unique(self.missing_report['word'].astype(str))
+            if missing_policy == 'fail':
+                raise KeyError(f"{len(missing_words)} dataset words have no usable embedding, e.g. {list(missing_words[:10])}.")
+            warnings.warn(f"{len(missing_words)} dataset words have no usable embedding "
+                          f"({len(self.missing_report)} cells, missing_policy={missing_policy}).")
+            affected = reasons != ''
+            if missing_policy == 'zero':
+                # The extra zero row at the end of the matrix
+                rows = np.where(affected, self.zero_row, rows)
+            elif missing_policy == 'skip':
+                kept = ~affected.any(axis=1)
+                dataset, rows = dataset[kept], rows[kept]
+        scores = self.scores(rows, metric)
+        words = dataset.to_numpy(dtype=object)
+        n_columns = rows.shape[1]
+
+        absent = (rows == -1) if missing_policy is None else np.zeros(rows.shape, dtype=bool)
+        excluded = ~absent & (self.excluded[rows] | self.excluded[rows[:, :1]])
+        broken = ~absent & ~self.present[rows] & ~self.excluded[rows] & (rows != self.zero_row)
+        # CosineAnchorTest stops at the first present word whose embedding (or the anchor's) is nan
+        cut = ~absent & (broken | broken[:, :1])
+        stop = np.where(cut.any(axis=1), cut.argmax(axis=1), n_columns)
+        truncated = np.arange(n_columns)[None, :] >= stop[:, None]
+        # An absent anchor gives three ('anchor', 'absent') pairs
+        absent_anchor = absent[:, 0]
+
+        data = {}
+        regular = not (absent.any() or excluded.any() or truncated.any())
+        for j in range(n_columns):
+            word_cells, score_cells = words[:, j], scores[:, j]
+            if not regular:
+                word_cells, score_cells = word_cells.copy(), score_cells.astype(object)
+                score_cells[absent[:, j]] = 'absent'
+                score_cells[excluded[:, j]] = 'EXCLUDED'
+                word_cells[truncated[:, j]] = None
+                score_cells[truncated[:, j]] = None
+                word_cells[absent_anchor] = words[absent_anchor, 0] if j < 3 else None
+                score_cells[absent_anchor] = 'absent' if j < 3 else None
+            data[columns[2 * j]], data[columns[2 * j + 1]] = word_cells, score_cells
+
+        df = pd.DataFrame(data=data, columns=columns, index=dataset.index).infer_objects()
+        keep = np.ones(len(df), dtype=bool)
+        for score_column in columns[3::2]:
+            keep &= (df[score_column] != 'EXCLUDED').to_numpy()
+        return df[keep]
+
 class CosineAnchorEditDistanceTest(Calculator):
     def __init__(self) -> None:
         super().__init__()
@@ -145,6 +273,7 @@ class Cosine1vsAll(Calculator):
         # reference word
         # list of words to compare
         # k = number of most similar words to the reference word        
+        # (many reference words at once: NearestNeighbours.CosineNearestNeighbours)
         @staticmethod
         def calc(reference_word: tuple, words_to_compare: dict, cosine_calculator: Calculator):
             '''
@@ -0,0 +1,286 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from embeddings.embedding_matrix import EmbeddingMatrix
+
+
+def normalize_rows(vectors):
+    vectors = np.nan_to_num(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+def blocked_top_k(queries, vocabulary, k=10, block_size=256, exclude=None, candidates=None):
+    """
+    Exact top-k by inner product (cosine on L2-normalized rows). The queries are processed in blocks:
+    only a (block_size, vocabulary size) score matrix and its argpartition indices are in memory at once.
+
+    :param queries: Matrix (n queries, d).
+    :param vocabulary: Matrix (vocabulary size, d).
+    :param exclude: Optional array (n queries,) with one vocabulary row to leave out per query (e.g. the query word itself), -1 for none.
+    :param candidates: Optional boolean array (vocabulary size,): the False rows are never returned.
+    :return: Tuple (indices, scores), arrays (n queries, k) sorted from the most similar.
+        Rows left out by exclude/candidates only appear, with score -inf, when k is larger than the remaining vocabulary.
+    """
+    n_queries, vocabulary_size = len(queries), len(vocabulary)
+    k = max(0, min(k, vocabulary_size))
+    indices = np.empty((n_queries, k), dtype=np.int64)
+    scores = np.empty((n_queries, k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+
+    for start in range(0, n_queries, block_size):
+        end = min(start + block_size, n_queries)
+        block_scores = queries[start:end] @ vocabulary.T
+        if candidates is not None:
+            block_scores[:, ~candidates] = -np.inf
+        if exclude is not None:
+            block_exclude = exclude[start:end]
+            excluded_rows = np.nonzero(block_exclude >= 0)[0]
+            block_scores[excluded_rows, block_exclude[excluded_rows]] = -np.inf
+
+        # argpartition only separates the k best from the others: just those k are sorted
+        if k < vocabulary_size:
+            top = np.argpartition(block_scores, vocabulary_size - k, axis=1)[:, vocabulary_size - k:]
+        else:
+            top = np.broadcast_to(np.arange(vocabulary_size), block_scores.shape)
+        top_scores = np.take_along_axis(block_scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        indices[start:end] = np.take_along_axis(top, order, axis=1)
+        scores[start:end] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, scores
+
+
+class CosineNearestNeighbours:
+    """
+    Batched replacement of Cosine1vsAll + DictValueSorter: the vocabulary {word: embedding} becomes one
+    L2-normalized float32 matrix, and many query words are searched at once with blocked_top_k.
+    Words without a usable embedding (nan, all zeros) are never returned as neighbours.
+    """
+    def __init__(self, embs_dict, block_size=256) -> None:
+        embedding_matrix = EmbeddingMatrix.from_dict(embs_dict)
+        np.nan_to_num(embedding_matrix.matrix, copy=False)
+        self.embeddings = embedding_matrix.l2_normalized()
+        self.block_size = block_size
+
+    @property
+    def keys(self):
+        return self.embeddings.keys
+
+    def search_vectors(self, vectors, k=10, exclude=None):
+        """
+        :param vectors: Query matrix (n, d), normalized here.
+        :return: Tuple (indices, scores), see blocked_top_k.
+        """
+        return blocked_top_k(normalize_rows(vectors), self.embeddings.matrix, k=k, block_size=self.block_size,
+                             exclude=exclude, candidates=self.embeddings.valid)
+
+    def search(self, words, k=10, exclude_self=True):
+        """
+        :param words: Query words, all in the vocabulary (KeyError otherwise).
+        :param exclude_self: If True, a word is not its own neighbour.
+        :return: Tuple (indices, scores), see blocked_top_k; indices are rows of self.keys.
+        """
+        rows = self.embeddings.rows(words)
+        return blocked_top_k(self.embeddings.matrix[rows], self.embeddings.matrix, k=k, block_size=self.block_size,
+                             exclude=rows if exclude_self else None, candidates=self.embeddings.valid)
+
+    def neighbours(self, words=None, k=10, exclude_self=True):
+        """
+        :param words: Query words; defaults to the whole vocabulary.
+        :return: Dictionary {word: [(neighbour, score), ...]}, the format of DictValueSorter.process_dict.
+        """
+        words = self.keys if words is None else list(words)
+        indices, scores = self.search(words, k=k, exclude_self=exclude_self)
+        return {word: [(self.keys[index], float(score)) for index, score in zip(word_indices, word_scores) if np.isfinite(score)]
+                for word, word_indices, word_scores in zip(words, indices, scores)}
+
+
+def spherical_kmeans(vectors, n_clusters, n_iterations=10, seed=0):
+    """
+    k-means on L2-normalized rows with cosine assignments and normalized mean centroids.
+
+    :return: Centroids matrix (n_clusters, d).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignments = blocked_top_k(vectors, centroids, k=1, block_size=1024)[0][:, 0]
+        # Sum of the vectors of every cluster: sort by cluster, then one reduceat
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=n_clusters)
+        non_empty = np.nonzero(counts)[0]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+        # Empty clusters keep their previous centroid
+        centroids[non_empty] = normalize_rows(sums)
+    return centroids
+
+def index_path(embeddings_path):
+    # The index folder lives next to the embeddings pickle it was built from
+    return os.path.splitext(embeddings_path)[0] + '_ivf'
+
+
+class IVFFlatIndex:
+    """
+    Approximate cosine search with an inverted file of flat lists. The vectors are clustered by spherical k-means
+    and a query is only scored against the lists of its nprobe closest centroids.
+    New embeddings can be inserted at any time (they go to the list of their closest centroid);
+    the index is saved as a folder of .npy files (loaded memory-mapped) plus the keys in json.
+    """
+    def __init__(self, centroids, keys=(), vectors=None, lists=None) -> None:
+        self.centroids = centroids
+        self.keys = list(keys)
+        self.vectors = np.zeros((0, centroids.shape[1]), dtype=np.float32) if vectors is None else vectors
+        self.lists = np.zeros(0, dtype=np.int64) if lists is None else lists
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self._inverted = None
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def train(cls, embs_dict, n_lists=None, n_iterations=10, sample_size=None, seed=0):
+        """
+        :param embs_dict: Dictionary {key: embedding}, as saved by the extraction scripts; unusable embeddings are left out.
+        :param n_lists: Number of inverted lists; defaults to 4 * sqrt(number of embeddings).
+        :param sample_size: Vectors used by k-means; defaults to 256 per list.
+        :return: IVFFlatIndex containing every usable embedding of embs_dict.
+        """
+        embedding_matrix = EmbeddingMatrix.from_dict(embs_dict)
+        keys = [key for key, valid in zip(embedding_matrix.keys, embedding_matrix.valid) if valid]
+        vectors = normalize_rows(embedding_matrix.matrix[embedding_matrix.valid])
+        if not len(vectors):
+            raise ValueError("No usable embeddings to index.")
+        n_lists = min(len(vectors), n_lists or max(1, int(4 * np.sqrt(len(vectors)))))
+        sample_size = min(len(vectors), sample_size or 256 * n_lists)
+        sample = vectors[np.random.default_rng(seed).choice(len(vectors), sample_size, replace=False)]
+
+        index = cls(spherical_kmeans(sample, n_lists, n_iterations=n_iterations, seed=seed))
+        index.add(keys, vectors)
+        return index
+
+    def add(self, keys, vectors):
+        """
+        Inserts (or replaces, for keys already indexed) embeddings without retraining the centroids.
+        """
+        keys = list(keys)
+        vectors = normalize_rows(vectors)
+        lists = blocked_top_k(vectors, self.centroids, k=1, block_size=1024)[0][:, 0]
+
+        new = [i for i, key in enumerate(keys) if key not in self.key_index]
+        replaced = [i for i, key in enumerate(keys) if key in self.key_index]
+        # concatenate copies the (possibly memory-mapped, read-only) arrays
+        self.vectors = np.concatenate([self.vectors, vectors[new]])
+        self.lists = np.concatenate([self.lists, lists[new]])
+        if replaced:
+            rows = np.array([self.key_index[keys[i]] for i in replaced])
+            self.vectors[rows], self.lists[rows] = vectors[replaced], lists[replaced]
+        for i in new:
+            self.key_index[keys[i]] = len(self.keys)
+            self.keys.append(keys[i])
+        self._inverted = None
+        return len(new)
+
+    def add_dict(self, embs_dict):
+        """
+        :return: Number of new keys (usable embeddings only).
+        """
+        embedding_matrix = EmbeddingMatrix.from_dict(embs_dict)
+        keys = [key for key, valid in zip(embedding_matrix.keys, embedding_matrix.valid) if valid]
+        return self.add(keys, embedding_matrix.matrix[embedding_matrix.valid])
+
+    def _inverted_lists(self):
+        # Rows sorted by list, and the offset of every list: rebuilt only after an insertion
+        if self._inverted is None:
+            order = np.argsort(self.lists, kind='stable')
+            offsets = np.searchsorted(self.lists[order], np.arange(self.n_lists + 1))
+            self._inverted = (order, offsets)
+        return self._inverted
+
+    def search_vectors(self, queries, k=10, nprobe=8, exclude=None):
+        """
+        :param queries: Query matrix (n, d), normalized here.
+        :param nprobe: Lists scored per query: more lists, higher recall and latency.
+        :param exclude: Optional array (n,) of index rows to leave out, -1 for none.
+        :return: Tuple (indices, scores), arrays (n, k) sorted from the most similar, padded with -1 / -inf.
+        """
+        queries = normalize_rows(queries)
+        order, offsets = self._inverted_lists()
+        nprobe = min(nprobe, self.n_lists)
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([order[offsets[probe]:offsets[probe + 1]] for probe in probes[i]])
+            if exclude is not None and exclude[i] >= 0:
+                candidates = candidates[candidates != exclude[i]]
+            if not len(candidates):
+                continue
+            top, top_scores = blocked_top_k(query[None, :], self.vectors[candidates], k=k)
+            indices[i, :top.shape[1]], scores[i, :top.shape[1]] = candidates[top[0]], top_scores[0]
+        return indices, scores
+
+    def search(self, words, k=10, nprobe=8, exclude_self=True):
+        """
+        :param words: Query words, all in the index (KeyError otherwise).
+        :return: Tuple (indices, scores), see search_vectors; indices are rows of self.keys.
+        """
+        rows = np.array([self.key_index[word] for word in words], dtype=np.int64)
+        return self.search_vectors(self.vectors[rows], k=k, nprobe=nprobe, exclude=rows if exclude_self else None)
+
+    def neighbours(self, words, k=10, nprobe=8, exclude_self=True):
+        """
+        :return: Dictionary {word: [(neighbour, score), ...]}, as CosineNearestNeighbours.neighbours.
+        """
+        indices, scores = self.search(words, k=k, nprobe=nprobe, exclude_self=exclude_self)
+        return {word: [(self.keys[index], float(score)) for index, score in zip(word_indices, word_scores) if index >= 0]
+                for word, word_indices, word_scores in zip(words, indices, scores)}
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(path, 'lists.npy'), self.lists)
+        with open(os.path.join(path, 'keys.json'), 'w') as f:
+            json.dump(self.keys, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, 'keys.json')) as f:
+            keys = json.load(f)
+        return cls(np.load(os.path.join(path, 'centroids.npy')),
+                   keys,
+                   np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'lists.npy')))
+
+
+def recall_benchmark(index: IVFFlatIndex, exact: CosineNearestNeighbours, words, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """
+    recall@k of the approximate index against the exact search, with the latency of one query at a time
+    (the interactive use case).
+
+    :param words: Query words, in both the index and the exact vocabulary.
+    :return: List of dictionaries, one per nprobe.
+    """
+    start = time.perf_counter()
+    exact_neighbours = [{neighbour for neighbour, _ in exact.neighbours([word], k=k)[word]} for word in words]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(words)
+
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        ann_neighbours = [{neighbour for neighbour, _ in index.neighbours([word], k=k, nprobe=nprobe)[word]} for word in words]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(words)
+        recall = np.mean([len(found & expected) / len(expected) for found, expected in zip(ann_neighbours, exact_neighbours) if expected])
+        results.append({'nprobe': nprobe, f'recall@{k}': float(recall), 'ms_per_query': ann_ms,
+                        'exact_ms_per_query': exact_ms, 'speedup': exact_ms / ann_ms if ann_ms > 0 else float('inf')})
+    return results
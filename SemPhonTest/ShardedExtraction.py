@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+# Registers the torch reductions: tensors in shared memory are passed to spawned workers by handle, not copied
+import torch.multiprocessing
+
+from embeddings.embeddings_cache import EmbeddingCache, CachedEmbeddings
+from embeddings.embeddings_models import model_output_name
+from SemPhonTest.BatchProcessing import TrainingBatch
+
+def wrap_with_cache(model, cache_path='', cache_max_gb=2.0):
+    # The sqlite connection is opened in the process that uses it
+    if cache_path:
+        model = CachedEmbeddings(model, EmbeddingCache(cache_path, max_bytes=int(cache_max_gb * 1024 ** 3)))
+    return model
+
+# Responsability: builds a model inside a worker process (the factory and its arguments are picklable, the model is not needed in the parent).
+def build_model(factory, model_type, model_arg, cache_path='', cache_max_gb=2.0, **kwargs):
+    return wrap_with_cache(factory.create_model(model_type, model_arg, **kwargs), cache_path, cache_max_gb)
+
+def share_model_weights(model):
+    """
+    Moves the parameters and buffers of a PyTorch transformer model to shared memory, so that all the
+    workers map the same pages instead of holding a copy each. Word2Vec is shared by memory-mapping its
+    store instead (see scripts/convert_word2vec.py).
+    """
+    if not isinstance(getattr(model, 'model', None), torch.nn.Module):
+        raise ValueError(f"Weight sharing is only available for PyTorch transformer models, not {model.__class__.__name__}.")
+    # Packed INT8 weights are not parameters: every spawned worker would get its own copy
+    if getattr(model, 'quantized', False):
+        raise ValueError("Weight sharing is not available for quantized models.")
+    model.model.share_memory()
+    return model
+
+def shard_batches(batch_indices, n_shards):
+    """
+    Splits the batch indices in n_shards contiguous shards of (almost) the same size.
+    """
+    batch_indices = list(batch_indices)
+    n_shards = max(1, min(n_shards, len(batch_indices)))
+    size, remainder = divmod(len(batch_indices), n_shards)
+    shards, start = [], 0
+    for shard in range(n_shards):
+        end = start + size + (1 if shard < remainder else 0)
+        shards.append(batch_indices[start:end])
+        start = end
+    return shards
+
+# State of a worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(num_threads, model_builder, shared_model, model_wrapper, extractor_class, training_set, output_file, batch_size, layers, prepare_batch):
+    torch.set_num_threads(num_threads)
+    model = model_builder() if shared_model is None else model_wrapper(shared_model)
+    _worker['model'] = model
+    _worker['extractor'] = extractor_class(model, output_file, batch_size, layers=layers)
+    _worker['training_set'] = training_set
+    _worker['batch_size'] = batch_size
+    _worker['prepare_batch'] = prepare_batch
+
+def _run_shard(shard):
+    training_batch = TrainingBatch()
+    batch_size = _worker['batch_size']
+    for batch_index in shard:
+        i = batch_index * batch_size
+        training_batch._get_batch(batch_size, i, _worker['training_set'])
+        training_batch.batch = _worker['prepare_batch'](training_batch.batch)
+        # Saved as batch_{i // batch_size}.pkl, exactly as in a single-process run
+        _worker['extractor']._extract_batch_embeddings_as_dict(i, batch_size, training_batch.batch)
+    cache = getattr(_worker['model'], 'cache', None)
+    if cache is not None:
+        cache.flush()
+    return model_output_name(_worker['model']), repr(cache) if cache is not None else None
+
+
+class ShardedExtractor:
+    """
+    Runs the batch extraction on several worker processes, each one with its own model instance (or with
+    the weights shared by the parent) and torch.set_num_threads(cores // workers). Every batch file keeps its single-process name,
+    so BatchConcatenator merges the shards into the same final pickle.
+    """
+    def __init__(self, model_builder, extractor_class, training_set, output_file, batch_size, workers, layers=None, prepare_batch=None,
+                 shared_model=None, model_wrapper=None) -> None:
+        """
+        :param model_builder: Picklable function without arguments returning the model (e.g. a partial of build_model).
+                              Not needed with shared_model.
+        :param shared_model: Model loaded once in the parent (see share_model_weights) and used by all the workers
+                             instead of model_builder. Its weights are passed to the workers by shared-memory handle.
+        :param model_wrapper: Picklable function applied to shared_model in every worker (e.g. a partial of wrap_with_cache).
+        :param extractor_class: BatchEmbsExtractor or BatchPhoneticEmbsExtractor.
+        :param prepare_batch: Picklable function applied to every batch before the extraction.
+        """
+        self.model_builder = model_builder
+        self.extractor_class = extractor_class
+        self.training_set = training_set
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.workers = workers
+        self.layers = layers
+        self.prepare_batch = prepare_batch if prepare_batch is not None else _identity
+        self.shared_model = shared_model
+        self.model_wrapper = model_wrapper if model_wrapper is not None else _identity
+        self.num_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    def run(self, first_batch, length):
+        """
+        :param first_batch: Index of the first batch to extract (to resume an interrupted run).
+        :param length: Number of items of the training set.
+        :return: Tuple (model class name, list of the workers' cache statistics).
+        """
+        n_batches = (length + self.batch_size - 1) // self.batch_size
+        shards = shard_batches(range(first_batch, n_batches), self.workers)
+        # Always spawn, also with a shared model: a forked worker would inherit the OpenMP thread pool that torch
+        # started in the parent while loading the model, which can deadlock it. The shared weights are still
+        # not copied, since the torch reductions pickle shared-memory tensors as handles.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=context, initializer=_init_worker,
+                                 initargs=(self.num_threads, self.model_builder, self.shared_model, self.model_wrapper,
+                                           self.extractor_class, self.training_set, self.output_file, self.batch_size,
+                                           self.layers, self.prepare_batch)) as executor:
+            results = list(executor.map(_run_shard, shards))
+        model_name = results[0][0] if results else None
+        return model_name, [stats for _, stats in results if stats is not None]
+
+def _identity(batch):
+    return batch
@@ -0,0 +1,100 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+class SimilarityMetric(ABC):
+    """
+    A similarity between row-aligned matrices (higher = more similar, as the ScoreComparator expects).
+    prepare transforms the whole embedding matrix once (normalization, centering...);
+    rowwise scores the gathered rows of the prepared matrix, pair by pair.
+    """
+    @staticmethod
+    def prepare(matrix):
+        return matrix
+
+    @staticmethod
+    @abstractmethod
+    def rowwise(A, B):
+        pass
+
+
+def _l2_normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+def _dot(A, B):
+    return np.einsum('ij,ij->i', A, B)
+
+
+# Registry {name: metric}: new metrics only need register_metric
+SIMILARITY_METRICS = {}
+
+def register_metric(name):
+    def decorator(metric_class):
+        SIMILARITY_METRICS[name] = metric_class()
+        return metric_class
+    return decorator
+
+def get_metric(name):
+    if name not in SIMILARITY_METRICS:
+        raise ValueError(f"Unknown metric {name}: choose one of {sorted(SIMILARITY_METRICS)}.")
+    return SIMILARITY_METRICS[name]
+
+
+@register_metric('cosine')
+class Cosine(SimilarityMetric):
+    @staticmethod
+    def prepare(matrix):
+        return _l2_normalize(matrix)
+
+    @staticmethod
+    def rowwise(A, B):
+        return _dot(A, B)
+
+@register_metric('dot')
+class Dot(SimilarityMetric):
+    @staticmethod
+    def rowwise(A, B):
+        return _dot(A, B)
+
+@register_metric('euclidean')
+class Euclidean(SimilarityMetric):
+    # Negative distance, so that closer means higher
+    @staticmethod
+    def rowwise(A, B):
+        return -np.linalg.norm(A - B, axis=1)
+
+@register_metric('angular')
+class Angular(SimilarityMetric):
+    # 1 - angle / pi: 1 for the same direction, 0 for opposite directions
+    @staticmethod
+    def prepare(matrix):
+        return _l2_normalize(matrix)
+
+    @staticmethod
+    def rowwise(A, B):
+        return 1 - np.arccos(np.clip(_dot(A, B), -1, 1)) / np.pi
+
+@register_metric('pearson')
+class Pearson(SimilarityMetric):
+    # Correlation between the dimensions of the two embeddings: cosine of the rows centered on their own mean
+    @staticmethod
+    def prepare(matrix):
+        return _l2_normalize(matrix - matrix.mean(axis=1, keepdims=True))
+
+    @staticmethod
+    def rowwise(A, B):
+        return _dot(A, B)
+
+@register_metric('centered_cosine')
+class CenteredCosine(SimilarityMetric):
+    # CKA-style: cosine after removing the mean embedding of the vocabulary (the common direction of anisotropic models)
+    @staticmethod
+    def prepare(matrix):
+        nonzero = np.any(matrix != 0, axis=1)
+        mean = matrix[nonzero].mean(axis=0) if nonzero.any() else np.zeros(matrix.shape[1], dtype=matrix.dtype)
+        return _l2_normalize(np.where(nonzero[:, None], matrix - mean, 0))
+
+    @staticmethod
+    def rowwise(A, B):
+        return _dot(A, B)
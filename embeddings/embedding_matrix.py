@@ -0,0 +1,87 @@
+import numpy as np
+import torch
+
+
+def to_row(embedding):
+    """
+    Flattens a stored embedding (tensor of shape (1, h), array, list) to a 1-d numpy array.
+
+    Several rows (e.g. one per occurrence of a contextual word) are read as CosineSim.calc reads them:
+    the last element of a 3-d tensor, then the first row.
+
+    :return: The row, or None for the placeholders of missing embeddings (nan, empty tensors).
+    """
+    if isinstance(embedding, torch.Tensor):
+        embedding = embedding.detach().cpu().numpy()
+        if embedding.ndim > 2:
+            embedding = embedding[-1]
+    if embedding is None or isinstance(embedding, str):
+        return None
+    array = np.asarray(embedding)
+    if array.ndim == 2 and array.shape[0] > 1:
+        array = array[0]
+    row = array.reshape(-1)
+    if row.size == 0 or (np.ndim(embedding) == 0 and np.isnan(row[0])):
+        return None
+    return row
+
+
+class EmbeddingMatrix:
+    """
+    An embeddings dictionary {key: embedding} stored as one contiguous matrix plus a key index.
+    valid is False for the keys without a usable embedding (missing, nan or all zeros), whose rows are zeros.
+    present is False only for the placeholders (nan, strings, empty tensors): all-zero embeddings are present.
+    """
+    def __init__(self, keys, matrix, valid, present=None) -> None:
+        self.keys = list(keys)
+        self.matrix = matrix
+        self.valid = valid
+        self.present = valid if present is None else present
+        self.index = {key: i for i, key in enumerate(self.keys)}
+
+    @classmethod
+    def from_dict(cls, embs_dict, keys=None, dtype=np.float32):
+        """
+        :param keys: Row order; defaults to the dictionary order. A key missing from embs_dict raises KeyError.
+        """
+        keys = list(embs_dict.keys()) if keys is None else list(keys)
+        rows = [to_row(embs_dict[key]) for key in keys]
+        sizes = {row.size for row in rows if row is not None}
+        if len(sizes) > 1:
+            raise ValueError(f"Embeddings with different sizes in the same dictionary: {sorted(sizes)}")
+        dimension = sizes.pop() if sizes else 0
+
+        matrix = np.zeros((len(keys), dimension), dtype=dtype)
+        present = np.zeros(len(keys), dtype=bool)
+        for i, row in enumerate(rows):
+            if row is not None:
+                matrix[i] = row
+                present[i] = True
+        valid = present & ~np.all(matrix == 0, axis=1)
+        return cls(keys, matrix, valid, present)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def rows(self, keys):
+        return np.array([self.index[key] for key in keys], dtype=np.int64)
+
+    def l2_normalized(self):
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        return EmbeddingMatrix(self.keys, self.matrix / np.where(norms > 0, norms, 1), self.valid, self.present)
+
+    def to_dict(self, invalid_value='EXCLUDED'):
+        return {key: self.matrix[i] if self.valid[i] else invalid_value for i, key in enumerate(self.keys)}
+
+
+def concatenate_blocks(block_1, block_2, weights=(1.0, 1.0)):
+    """
+    Weighted concatenation of two row-aligned EmbeddingMatrix, written into one preallocated matrix.
+
+    :return: EmbeddingMatrix valid where both blocks are valid.
+    """
+    fused = np.empty((len(block_1.keys), block_1.dimension + block_2.dimension), dtype=np.float32)
+    np.multiply(block_1.matrix, weights[0], out=fused[:, :block_1.dimension])
+    np.multiply(block_2.matrix, weights[1], out=fused[:, block_1.dimension:])
+    return EmbeddingMatrix(block_1.keys, fused, block_1.valid & block_2.valid, block_1.present & block_2.present)
@@ -0,0 +1,298 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from embeddings.embeddings_models import Embeddings, embed_texts, model_output_name
+
+# Messages are a fixed-size prefix (header length, payload length), a json header and a float32 payload
+_PREFIX = struct.Struct('!II')
+
+
+def _recv_exactly(sock, n_bytes):
+    chunks = []
+    while n_bytes > 0:
+        chunk = sock.recv(min(n_bytes, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by the other side.")
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, header, payload=b''):
+    header = json.dumps(header).encode('utf-8')
+    sock.sendall(_PREFIX.pack(len(header), len(payload)) + header + payload)
+
+def recv_message(sock):
+    header_length, payload_length = _PREFIX.unpack(_recv_exactly(sock, _PREFIX.size))
+    header = json.loads(_recv_exactly(sock, header_length).decode('utf-8'))
+    return header, _recv_exactly(sock, payload_length)
+
+def _encode_embedding(embedding, arrays):
+    if isinstance(embedding, dict):
+        # Layer selection: {layer: embedding}
+        return {'kind': 'layers', 'layers': [int(layer) for layer in embedding],
+                'items': [_encode_embedding(value, arrays) for value in embedding.values()]}
+    kind = 'numpy'
+    if isinstance(embedding, torch.Tensor):
+        kind = 'torch'
+        embedding = embedding.detach().cpu().numpy()
+    elif isinstance(embedding, list):
+        kind = 'list'
+    elif np.ndim(embedding) == 0:
+        kind = 'scalar'
+    array = np.asarray(embedding, dtype=np.float32)
+    arrays.append(array.reshape(-1))
+    return {'kind': kind, 'shape': list(array.shape)}
+
+def encode_embeddings(embeddings):
+    """
+    :return: Tuple (metadata, payload): the embeddings as one float32 buffer, and for each one the
+             kind (torch, numpy, list, scalar, or layers for a {layer: embedding} dictionary) and shape
+             needed to rebuild it on the client side.
+    """
+    arrays = []
+    metadata = [_encode_embedding(embedding, arrays) for embedding in embeddings]
+    payload = np.concatenate(arrays).tobytes() if arrays else b''
+    return metadata, payload
+
+def _decode_embedding(item, buffer, start):
+    if item['kind'] == 'layers':
+        embedding = {}
+        for layer, layer_item in zip(item['layers'], item['items']):
+            embedding[layer], start = _decode_embedding(layer_item, buffer, start)
+        return embedding, start
+    size = int(np.prod(item['shape'])) if item['shape'] else 1
+    array = buffer[start:start + size].reshape(item['shape']).copy()
+    start += size
+    if item['kind'] == 'torch':
+        return torch.from_numpy(array), start
+    if item['kind'] == 'list':
+        return array.tolist(), start
+    if item['kind'] == 'scalar':
+        return np.float64(array), start
+    return array, start
+
+def decode_embeddings(metadata, payload):
+    buffer = np.frombuffer(payload, dtype=np.float32)
+    embeddings, start = [], 0
+    for item in metadata:
+        embedding, start = _decode_embedding(item, buffer, start)
+        embeddings.append(embedding)
+    return embeddings
+
+
+class _Job:
+    def __init__(self, method, inputs, kwargs) -> None:
+        self.method = method
+        self.inputs = inputs
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class ModelWorker(threading.Thread):
+    """
+    Owns one model: the requests of all the clients are queued and run together, up to max_batch inputs
+    or max_wait seconds after the first request of a batch.
+    """
+    def __init__(self, model, max_batch=256, max_wait=0.005) -> None:
+        super().__init__(daemon=True)
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+
+    def submit(self, method, inputs, kwargs):
+        job = _Job(method, inputs, kwargs)
+        self.queue.put(job)
+        return job.future
+
+    def stop(self):
+        self.queue.put(None)
+
+    def _collect(self, first):
+        jobs, n_inputs = [first], len(first.inputs)
+        deadline = time.monotonic() + self.max_wait
+        while n_inputs < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                # Stop after this batch
+                self.queue.put(None)
+                break
+            jobs.append(job)
+            n_inputs += len(job.inputs)
+        return jobs
+
+    def _call(self, method, inputs, kwargs):
+        if method == 'embed_batch':
+            return embed_texts(self.model, inputs)
+        if method == 'embed_from_sentence_batch':
+            return self.model.embed_from_sentence_batch([tuple(pair) for pair in inputs], **kwargs)
+        raise ValueError(f"Unsupported method: {method}")
+
+    def run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            # Only requests with the same method and arguments can share a forward pass
+            groups = {}
+            for job in self._collect(first):
+                groups.setdefault((job.method, json.dumps(job.kwargs, sort_keys=True)), []).append(job)
+            for (method, _), jobs in groups.items():
+                try:
+                    outputs = self._call(method, [item for job in jobs for item in job.inputs], jobs[0].kwargs)
+                except Exception as e:
+                    for job in jobs:
+                        job.future.set_exception(e)
+                    continue
+                start = 0
+                for job in jobs:
+                    job.future.set_result(outputs[start:start + len(job.inputs)])
+                    start += len(job.inputs)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, _ = recv_message(self.connection)
+            except ConnectionError:
+                return
+            try:
+                send_message(self.connection, *self.server.answer(header))
+            except Exception as e:
+                send_message(self.connection, {'status': 'error', 'error': f'{e.__class__.__name__}: {e}'})
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Local embedding daemon: keeps the models loaded and answers the EmbeddingClient requests on a UNIX socket.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, models, max_batch=256, max_wait=0.005) -> None:
+        """
+        :param models: Dictionary {model name: Embeddings instance}.
+        """
+        if os.path.exists(socket_path):
+            # Stale socket of a previous server; any other file is left alone
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise ValueError(f"{socket_path} exists and is not a socket.")
+            os.remove(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        self.socket_path = socket_path
+        self.models = models
+        self.workers = {name: ModelWorker(model, max_batch, max_wait) for name, model in models.items()}
+        for worker in self.workers.values():
+            worker.start()
+
+    def answer(self, header):
+        model_name = header.get('model')
+        if model_name not in self.models:
+            raise ValueError(f"Model {model_name} is not loaded by the server (available: {sorted(self.models)}).")
+        model = self.models[model_name]
+        if header['op'] == 'describe':
+            return {'status': 'ok',
+                    'class_name': model_output_name(model),
+                    'contextual': hasattr(model, 'embed_from_sentence')}, b''
+        outputs = self.workers[model_name].submit(header['method'], header['inputs'], header.get('kwargs', {})).result()
+        metadata, payload = encode_embeddings(outputs)
+        return {'status': 'ok', 'embeddings': metadata}, payload
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers.values():
+            worker.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class EmbeddingClient:
+    def __init__(self, socket_path) -> None:
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        # One request at a time per connection
+        self.lock = threading.Lock()
+
+    def request(self, header):
+        with self.lock:
+            send_message(self.sock, header)
+            response, payload = recv_message(self.sock)
+        if response['status'] != 'ok':
+            raise RuntimeError(f"Embedding server error: {response['error']}")
+        return response, payload
+
+    def describe(self, model_name):
+        return self.request({'op': 'describe', 'model': model_name})[0]
+
+    def embed(self, model_name, method, inputs, **kwargs):
+        response, payload = self.request({'op': 'embed', 'model': model_name, 'method': method, 'inputs': inputs, 'kwargs': kwargs})
+        return decode_embeddings(response['embeddings'], payload)
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteEmbeddings(Embeddings):
+    """
+    Embeddings model served by an EmbeddingServer: same API as the local model, without loading it.
+    """
+    def __init__(self, socket_path, model_name) -> None:
+        super().__init__()
+        self.model_name = model_name
+        self.client = EmbeddingClient(socket_path)
+        description = self.client.describe(model_name)
+        # Class of the served model, used for the output file names
+        self.remote_class_name = description['class_name']
+        # Contextual extraction is only exposed when the served model supports it
+        if description['contextual']:
+            self.embed_from_sentence = self._embed_from_sentence
+            self.embed_from_sentence_batch = self._embed_from_sentence_batch
+
+    def embed(self, input_text):
+        return self.embed_batch([input_text])[0]
+
+    def embed_batch(self, list_of_texts):
+        return self.client.embed(self.model_name, 'embed_batch', list(list_of_texts))
+
+    def _embed_from_sentence_batch(self, pairs, max_length=512, layers=None):
+        # A range is not json-serializable
+        layers = layers if layers is None or isinstance(layers, (int, str)) else list(layers)
+        return self.client.embed(self.model_name, 'embed_from_sentence_batch', [list(pair) for pair in pairs],
+                                 max_length=max_length, layers=layers)
+
+    def _embed_from_sentence(self, sentence, word, max_length=512, layers=None):
+        return self._embed_from_sentence_batch([(sentence, word)], max_length=max_length, layers=layers)[0]
+
+
+def load_models(model_names, p2v_model=None, w2v_store=None, quantized=False):
+    """
+    :return: Dictionary {model name: model} built with PhoneticModelFactory/SemanticModelFactory.
+    """
+    from embeddings.embeddings_models import PhoneticModelFactory, SemanticModelFactory
+    models = {}
+    for model_name in model_names:
+        # Quantization only applies to the transformer models
+        model_quantized = quantized and model_name in ('ClassicBert', 'XPhoneBERT')
+        if model_name in ('ClassicBert', 'Word2Vec'):
+            models[model_name] = SemanticModelFactory.create_model(model_name, '', quantized=model_quantized, w2v_store=w2v_store)
+        else:
+            models[model_name] = PhoneticModelFactory.create_model(model_name, p2v_model, quantized=model_quantized)
+    return models
@@ -0,0 +1,294 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import torch
+
+from embeddings.embeddings_models import Embeddings, TransformerEmbeddings, Phoneme2Vec, Word2Vec, ArticulatoryPhonemes
+
+
+# Cache hits whose access time is kept in memory before being written
+MAX_PENDING_TOUCHES = 100000
+
+
+def model_fingerprint(model):
+    """
+    Identifies a model configuration: two models with the same fingerprint return the same embeddings.
+
+    :return: Tuple (model id, config hash).
+    """
+    model_id = model.__class__.__name__
+    config = {}
+    if isinstance(model, TransformerEmbeddings) and hasattr(model, 'model'):
+        model_id = model.model.config.name_or_path or model_id
+        config = {'config': model.model.config.to_json_string(use_diff=False),
+                  'depth': model.depth,
+                  'quantized': getattr(model, 'quantized', False)}
+    elif isinstance(model, TransformerEmbeddings):
+        # ONNX backend: same graph as the PyTorch model
+        config = {'backend': model_id}
+    elif isinstance(model, Phoneme2Vec):
+        config = {'vectors': hashlib.sha256(np.ascontiguousarray(model.p2v_model.model.wv.vectors).tobytes()).hexdigest(),
+                  'phonetic_dictionary': model.phonetic_dictionary is not None}
+    elif isinstance(model, ArticulatoryPhonemes):
+        # The features come from the panphon tables, which change between panphon releases
+        config = {'panphon': importlib.metadata.version('panphon'),
+                  'features': hashlib.sha256(np.ascontiguousarray(model.table).tobytes()).hexdigest()}
+    elif isinstance(model, Word2Vec):
+        # A restricted store embeds the words missing from its vocabulary as zeros: its identity is its vocabulary
+        # (str: stores converted before restrict_vectors may still have None keys)
+        config = {'store': os.path.abspath(model.store_path) if model.store_path else 'word2vec-google-news-300',
+                  'vocabulary_size': len(model.tokens.index_to_key),
+                  'vocabulary': hashlib.sha256('\n'.join(map(str, model.tokens.index_to_key)).encode('utf-8')).hexdigest(),
+                  'vector_size': model.tokens.vector_size}
+    config_hash = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+    return model_id, config_hash
+
+
+class EmbeddingCache:
+    """
+    On-disk, content-addressed embedding store shared across runs and datasets.
+    Entries are keyed by (model id, config hash, layer, input) and evicted in LRU order once the
+    store is larger than max_bytes. SQLite in WAL mode allows concurrent readers from several processes.
+    """
+    def __init__(self, path, max_bytes=2 * 1024 ** 3) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # LRU touches of the cache hits, written in batches so that reads never write to the database
+        self.pending_touches = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, kind TEXT, dtype TEXT, '
+                                'shape TEXT, data BLOB, size INTEGER, last_access REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        # Running total of the embedding sizes, updated with every insertion and deletion:
+        # eviction never has to scan the whole table. Caches created without it are summed once.
+        self.connection.execute('CREATE TABLE IF NOT EXISTS total_size (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+        if self.connection.execute('SELECT size FROM total_size').fetchone() is None:
+            self.connection.execute('INSERT OR IGNORE INTO total_size SELECT 0, COALESCE(SUM(size), 0) FROM embeddings')
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(model_id, config_hash, layer, model_input):
+        content = json.dumps([model_id, config_hash, layer, model_input], ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _serialize(embedding):
+        kind = 'numpy'
+        if isinstance(embedding, torch.Tensor):
+            kind = 'torch'
+            embedding = embedding.detach().cpu().numpy()
+        elif isinstance(embedding, list):
+            kind = 'list'
+        array = np.ascontiguousarray(np.asarray(embedding))
+        return kind, str(array.dtype), json.dumps(array.shape), array.tobytes()
+
+    @staticmethod
+    def _deserialize(kind, dtype, shape, data):
+        array = np.frombuffer(data, dtype=np.dtype(dtype)).reshape(json.loads(shape)).copy()
+        if kind == 'torch':
+            return torch.from_numpy(array)
+        if kind == 'list':
+            return array.tolist()
+        if array.ndim == 0:
+            return array.item()
+        return array
+
+    def get_many(self, keys):
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # SQLite limits the number of parameters of a single query
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.connection.execute(f'SELECT key, kind, dtype, shape, data FROM embeddings WHERE key IN ({",".join("?" * len(chunk))})',
+                                           chunk).fetchall()
+            for key, kind, dtype, shape, data in rows:
+                found[key] = self._deserialize(kind, dtype, shape, data)
+        now = time.time()
+        self.pending_touches.update((key, now) for key in found)
+        if len(self.pending_touches) >= MAX_PENDING_TOUCHES:
+            self.flush()
+        return found
+
+    def _write_touches(self):
+        self.connection.executemany('UPDATE embeddings SET last_access = ? WHERE key = ?',
+                                    [(last_access, key) for key, last_access in self.pending_touches.items()])
+        self.pending_touches = {}
+
+    def flush(self):
+        # Writes the pending LRU touches (called by put_many and at the end of an extraction)
+        if self.pending_touches:
+            self._write_touches()
+            self.connection.commit()
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, embedding in items.items():
+            kind, dtype, shape, data = self._serialize(embedding)
+            rows.append((key, kind, dtype, shape, data, len(data), now))
+        # One write transaction for the touches, the insertions and the size total: concurrent writers
+        # (other processes) never see a total that does not match the table
+        self.connection.execute('BEGIN IMMEDIATE')
+        self._write_touches()
+        replaced_size = self._stored_size([row[0] for row in rows])
+        self.connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.execute('UPDATE total_size SET size = size + ?', (sum(row[5] for row in rows) - replaced_size,))
+        self._evict()
+        self.connection.commit()
+
+    def _stored_size(self, keys):
+        # Size of the entries that are already stored among keys (primary key lookups only)
+        size = 0
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            size += self.connection.execute(f'SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({",".join("?" * len(chunk))})',
+                                            chunk).fetchone()[0]
+        return size
+
+    def total_size(self):
+        return self.connection.execute('SELECT size FROM total_size').fetchone()[0]
+
+    def _evict(self):
+        # Runs inside the put_many transaction
+        total_size = self.total_size()
+        if total_size <= self.max_bytes:
+            return
+        to_free = total_size - self.max_bytes
+        freed, keys = 0, []
+        for key, size in self.connection.execute('SELECT key, size FROM embeddings ORDER BY last_access'):
+            keys.append((key,))
+            freed += size
+            if freed >= to_free:
+                break
+        self.connection.executemany('DELETE FROM embeddings WHERE key = ?', keys)
+        self.connection.execute('UPDATE total_size SET size = size - ?', (freed,))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def __repr__(self) -> str:
+        stats = self.stats()
+        return f"EmbeddingCache({self.path}): {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.2%}"
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Puts an EmbeddingCache in front of any Embeddings model: only the inputs that were never
+    embedded with the same model configuration are computed.
+    """
+    def __init__(self, embeddings_model, cache: EmbeddingCache) -> None:
+        super().__init__()
+        self.embeddings_model = embeddings_model
+        self.cache = cache
+        self.model_id, self.config_hash = model_fingerprint(embeddings_model)
+        # Contextual extraction is only exposed when the wrapped model supports it
+        # (BatchEmbsExtractor.check_if_contextual_model relies on it)
+        if hasattr(embeddings_model, 'embed_from_sentence'):
+            self.embed_from_sentence = self._embed_from_sentence
+            self.embed_from_sentence_batch = self._embed_from_sentence_batch
+        if hasattr(embeddings_model, 'embed_targets_from_sentence_batch'):
+            self.embed_targets_from_sentence_batch = self._embed_targets_from_sentence_batch
+        if hasattr(embeddings_model, 'embed_all_occurrences_batch'):
+            self.embed_all_occurrences_batch = self._embed_all_occurrences_batch
+
+    def __getattr__(self, name):
+        # Everything else (tokenizer, ...) comes from the wrapped model
+        if name == 'embeddings_model':
+            raise AttributeError(name)
+        return getattr(self.embeddings_model, name)
+
+    def _layer_ids(self, layers):
+        if layers is None:
+            return [None]
+        n_hidden_states = self.embeddings_model.model.config.num_hidden_layers + 1
+        return self.embeddings_model._resolve_layers(layers, n_hidden_states)
+
+    def _cached(self, model_inputs, layers, compute):
+        # model_inputs: json-serializable inputs; compute: function from the missing positions to their embeddings
+        layer_ids = self._layer_ids(layers)
+        keys = [[self.cache.make_key(self.model_id, self.config_hash, layer, model_input) for layer in layer_ids]
+                for model_input in model_inputs]
+        found = self.cache.get_many([key for input_keys in keys for key in input_keys])
+
+        missing = [i for i, input_keys in enumerate(keys) if not all(key in found for key in input_keys)]
+        self.cache.hits += len(model_inputs) - len(missing)
+        self.cache.misses += len(missing)
+        if missing:
+            to_store = {}
+            for i, embedding in zip(missing, compute(missing)):
+                for layer, key in zip(layer_ids, keys[i]):
+                    found[key] = embedding if layer is None else embedding[layer]
+                    to_store[key] = found[key]
+            self.cache.put_many(to_store)
+
+        if layers is None:
+            return [found[input_keys[0]] for input_keys in keys]
+        return [{layer: found[key] for layer, key in zip(layer_ids, input_keys)} for input_keys in keys]
+
+    def embed(self, input_text, layers=None):
+        return self.embed_batch([input_text], layers=layers)[0]
+
+    def embed_batch(self, list_of_texts, layers=None):
+        def compute(missing):
+            texts = [list_of_texts[i] for i in missing]
+            if hasattr(self.embeddings_model, 'embed_batch'):
+                if layers is None:
+                    return self.embeddings_model.embed_batch(texts)
+                return self.embeddings_model.embed_batch(texts, layers=layers)
+            return [self.embeddings_model.embed(text) for text in texts]
+        return self._cached([['embed', text] for text in list_of_texts], layers, compute)
+
+    @staticmethod
+    def _sentence_key(sentence, word, max_length, first_occurrence):
+        # 'sentence' entries only hold the first occurrence of the word
+        return ['sentence' if first_occurrence else 'sentence_occurrences', sentence, word, max_length]
+
+    def _embed_from_sentence_batch(self, pairs, max_length=512, layers=None, first_occurrence=False):
+        def compute(missing):
+            return self.embeddings_model.embed_from_sentence_batch([pairs[i] for i in missing], max_length=max_length, layers=layers,
+                                                                   first_occurrence=first_occurrence)
+        return self._cached([self._sentence_key(sentence, word, max_length, first_occurrence) for sentence, word in pairs], layers, compute)
+
+    def _embed_targets_from_sentence_batch(self, items, max_length=512, layers=None, packed=False, first_occurrence=False):
+        # Entries are cached per (sentence, word); the sentences with a missing word are encoded once for all their words
+        pairs = [(sentence, word) for sentence, words in items for word in words]
+        def compute(missing):
+            missing_words = {}
+            for i in missing:
+                missing_words.setdefault(pairs[i][0], []).append(pairs[i][1])
+            sentences = list(missing_words.keys())
+            targets = self.embeddings_model.embed_targets_from_sentence_batch([(sentence, missing_words[sentence]) for sentence in sentences],
+                                                                              max_length=max_length, layers=layers, packed=packed,
+                                                                              first_occurrence=first_occurrence)
+            by_pair = {}
+            for sentence, sentence_targets in zip(sentences, targets):
+                for word, embedding in zip(missing_words[sentence], sentence_targets):
+                    by_pair[(sentence, word)] = embedding
+            return [by_pair[pairs[i]] for i in missing]
+        embeddings = self._cached([self._sentence_key(sentence, word, max_length, first_occurrence) for sentence, word in pairs], layers, compute)
+        targets, start = [], 0
+        for _, words in items:
+            targets.append(embeddings[start:start + len(words)])
+            start += len(words)
+        return targets
+
+    def _embed_all_occurrences_batch(self, pairs, max_length=512, stride=None, layers=None):
+        def compute(missing):
+            return self.embeddings_model.embed_all_occurrences_batch([pairs[i] for i in missing], max_length=max_length, stride=stride, layers=layers)
+        return self._cached([['all_occurrences', sentence, word, max_length, stride] for sentence, word in pairs], layers, compute)
+
+    def _embed_from_sentence(self, sentence, word, max_length=512, layers=None, all_occurrences=False, stride=None):
+        if all_occurrences:
+            return self._embed_all_occurrences_batch([(sentence, word)], max_length=max_length, stride=stride, layers=layers)[0]
+        return self._embed_from_sentence_batch([(sentence, word)], max_length=max_length, layers=layers)[0]
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from data.data_source import CMUdictionary2Vec
+from embeddings.embedding_matrix import EmbeddingMatrix, concatenate_blocks
 import numpy as np
 import panphon
 from transformers import AutoModel, AutoTokenizer
@@ -8,6 +9,10 @@ import gensim.downloader
 import torch
 
 import logging
+import re
+import unicodedata
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 logging.basicConfig(
     filename='log_problematic_Xphone.txt',
     level=logging.ERROR,  # Log only error-level messages
@@ -47,6 +52,34 @@ def check_same_keys(dict1, dict2):
         raise ValueError(error_message)
 
 
+def locate_all_words(sentence, word, ignore_case=False):
+    # Character spans of the whole-word occurrences of word in sentence. Never a match inside another word
+    # (e.g. 'he' in 'the'): an empty list lets the caller record the word as missing.
+    flags = re.IGNORECASE if ignore_case else 0
+    escaped_word = re.escape(word.strip())
+    return [match.span() for match in re.finditer(r'(?<!\w)' + escaped_word + r'(?!\w)', sentence, flags)]
+
+def locate_word(sentence, word, ignore_case=False):
+    # Character span of the first occurrence found by locate_all_words
+    spans = locate_all_words(sentence, word, ignore_case)
+    return spans[0] if spans else None
+
+def segment_mean(vectors, indices, offsets):
+    """
+    Mean of the rows of vectors selected by a CSR-style (indices, offsets) pair, with a single gather.
+
+    :return: Tuple (means, counts): means[i] is the mean of vectors[indices[offsets[i]:offsets[i + 1]]]
+             (zeros for empty segments), counts[i] the number of rows of the segment i.
+    """
+    counts = np.diff(offsets)
+    sums = np.zeros((len(counts), vectors.shape[1]), dtype=np.float64)
+    non_empty = counts > 0
+    if indices.size:
+        # reduceat is only defined on non-empty segments
+        sums[non_empty] = np.add.reduceat(np.asarray(vectors[indices], dtype=np.float64), offsets[:-1][non_empty], axis=0)
+    return sums / np.maximum(counts, 1)[:, None], counts
+
+
 # A class that needs to be updated with the available models and that extracts the correct model's object given the right parameters.
 class ModelFactory(ABC):
 
@@ -61,11 +94,20 @@ class Embeddings(ABC):
     def embed(self, sentence):
         pass
 
+def model_output_name(model):
+    # Name of the output files: the model class, also behind the embeddings cache or with another backend (output_name)
+    model = getattr(model, 'embeddings_model', model)
+    return getattr(model, 'output_name', model.__class__.__name__)
+
 class Phoneme2Vec(Embeddings):
+    # Above this number of unknown phonemes, an ARPABET string is represented by a vector of zeros
+    max_unknown_phonemes = 2
+
     def __init__(self, p2v_model, phonetic_dictionary = None) -> None:
         super().__init__()
         self.p2v_model = p2v_model
         self.keys = p2v_model.model.wv.key_to_index
+        self.vectors = p2v_model.model.wv.vectors
         self.phonetic_dictionary = phonetic_dictionary
 
     def embed(self, sentence):
@@ -76,119 +118,549 @@ class Phoneme2Vec(Embeddings):
         return embeddings
     
     def embed_dict(self, sentence):
-        sentence = sentence.lower().strip().split()
-        phonetic_list = []
-        for word in sentence: 
-            word = [self.phonetic_dictionary.get('the') if self.phonetic_dictionary.get(word) is None else self.phonetic_dictionary.get(word)][0]
-            phonetic_word = CMUdictionary2Vec.list_management_for_cmu(word)
-            for phoneme in phonetic_word:
-                index = self.keys[phoneme]
-                phoneme_embedding = self.p2v_model[index]
-                phonetic_list.append(phoneme_embedding)
-        return np.mean(phonetic_list, axis=0)
+        return self.embed_batch([sentence])[0]
     
     def embed_from_arp(self, sentence):
-        
-        def __preprocessing_sentence(sentence):
-            import re
-            if '   ' in sentence:
-                n_sentence = []
-                for element in sentence.split('   '):
-                    element = re.sub(r'\s', '', element)
-                    n_sentence.append(element)
-                return n_sentence
+        return self.embed_batch([sentence])[0]
+
+    def _phonemes_from_dict(self, sentence):
+        phonemes = []
+        for word in sentence.lower().strip().split():
+            word = [self.phonetic_dictionary.get('the') if self.phonetic_dictionary.get(word) is None else self.phonetic_dictionary.get(word)][0]
+            phonemes.extend(CMUdictionary2Vec.list_management_for_cmu(word))
+        return phonemes
+
+    def _index_arrays(self, list_of_texts):
+        """
+        Tokenizes all the inputs once into a CSR-style representation of the phoneme indices.
+
+        :return: Tuple (indices, offsets, unknown): the phonemes of the input i are indices[offsets[i]:offsets[i + 1]],
+                 unknown[i] is the number of phonemes of the input i missing from the vocabulary.
+        """
+        indices, offsets, unknown = [], [0], []
+        for text in list_of_texts:
+            if self.phonetic_dictionary is not None:
+                # Every phoneme of the CMU dictionary is in the vocabulary (KeyError otherwise, as before)
+                indices.extend(self.keys[phoneme] for phoneme in self._phonemes_from_dict(text))
+                unknown.append(0)
             else:
-                sentence.split()
-                return sentence
-        
-        sentence = __preprocessing_sentence(sentence)
-        phonetic_list = []
-        sentence = sentence.split(' ')
-        unknown_token = [0.0] * len(self.p2v_model[0])
-        unk_count = 0
-        for phoneme in sentence:
-            if phoneme not in self.keys:
-                if unk_count < 2:
-                    unk_count += 1
-                    continue
-                else:
-                    print(f'impossible to represent {sentence}. Vector with all 0 out.')
-                    return unknown_token
-            index = self.keys[phoneme]
-            phoneme_embedding = self.p2v_model[index]
-            phonetic_list.append(phoneme_embedding)
-        return np.mean(phonetic_list, axis=0)
+                # Words of a transcription are separated by '   ': all their phonemes are averaged together
+                phonemes = [phoneme for word in text.split('   ') for phoneme in word.split(' ')]
+                known = [self.keys[phoneme] for phoneme in phonemes if phoneme in self.keys]
+                indices.extend(known)
+                unknown.append(len(phonemes) - len(known))
+            offsets.append(len(indices))
+        return np.array(indices, dtype=np.int64), np.array(offsets, dtype=np.int64), np.array(unknown)
+
+    def embed_batch(self, list_of_texts):
+        """
+        Embeds all the inputs with a single gather and segment mean over the vectors matrix.
+        An ARPABET string with more than max_unknown_phonemes unknown phonemes gets a list of zeros,
+        the unknown phonemes are skipped otherwise; an input without known phonemes gets nan.
 
-        
-class ArticulatoryPhonemes(Embeddings):
+        :param list_of_texts: ARPABET strings (phonemes separated by a space), or words if a phonetic dictionary is used.
+        :return: List of embeddings, in the same order as the inputs.
+        """
+        embeddings = [None] * len(list_of_texts)
+        indices, offsets, unknown = self._index_arrays(list_of_texts)
+        means, counts = segment_mean(self.vectors, indices, offsets)
+        means = means.astype(self.vectors.dtype)
+
+        for i, text in enumerate(list_of_texts):
+            if unknown[i] > self.max_unknown_phonemes:
+                print(f'impossible to represent {text.split(" ")}. Vector with all 0 out.')
+                embeddings[i] = [0.0] * self.vectors.shape[1]
+            elif counts[i] == 0:
+                embeddings[i] = np.float64(np.nan)
+            else:
+                embeddings[i] = means[i]
+        return embeddings
 
+
+class ArticulatoryPhonemes(Embeddings):
+    """
+    Mean of the panphon articulatory features of the IPA segments of a string.
+    The feature vectors of the whole segment inventory are stored once in a numpy table and strings are
+    segmented with a longest-match trie, which is what FeatureTable.ipa_segs does with its regex.
+    """
     def __init__(self) -> None:
         super().__init__()
         self.ft = panphon.FeatureTable()
+        segments = list(self.ft.seg_dict.keys())
+        self.segment_to_index = {segment: i for i, segment in enumerate(segments)}
+        self.table = np.array([self._numeric(self.ft.seg_dict[segment]) for segment in segments], dtype=np.int64)
+        self.trie = self._build_trie(segments)
+
+    @staticmethod
+    def _numeric(segment):
+        # Depending on the panphon version, seg_dict stores Segment objects or lists of features
+        return segment.numeric() if hasattr(segment, 'numeric') else list(segment)
+
+    @staticmethod
+    def _build_trie(segments):
+        # The None key of a node holds the index of the segment ending there
+        trie = {}
+        for i, segment in enumerate(segments):
+            node = trie
+            for char in segment:
+                node = node.setdefault(char, {})
+            node[None] = i
+        return trie
+
+    def segment(self, input_phonemes):
+        """
+        :return: Indices (rows of self.table) of the longest-match segmentation; characters that do not
+                 start any segment are skipped, as in panphon.
+        """
+        word = unicodedata.normalize('NFD', input_phonemes)
+        indices = []
+        start = 0
+        while start < len(word):
+            node, match, end = self.trie, None, start
+            for position in range(start, len(word)):
+                node = node.get(word[position])
+                if node is None:
+                    break
+                if None in node:
+                    match, end = node[None], position + 1
+            if match is None:
+                start += 1
+            else:
+                indices.append(match)
+                start = end
+        return indices
 
     def embed(self, input_phonemes):
-        articulatory_characteristics = self.ft.word_fts(input_phonemes)
-        embeddings = [art_char.numeric() for art_char in articulatory_characteristics]
-        embeddings = np.mean(embeddings, axis=0)
+        return self.embed_batch([input_phonemes])[0]
+
+    def embed_batch(self, list_of_texts):
+        """
+        :param list_of_texts: IPA strings.
+        :return: List of mean-pooled feature vectors (nan for a string without IPA segments).
+        """
+        indices, offsets = [], [0]
+        for text in list_of_texts:
+            indices.extend(self.segment(text))
+            offsets.append(len(indices))
+        means, counts = segment_mean(self.table, np.array(indices, dtype=np.int64), np.array(offsets, dtype=np.int64))
+        return [means[i] if counts[i] > 0 else np.float64(np.nan) for i in range(len(list_of_texts))]
+
+    def check_against_panphon(self, list_of_texts):
+        """
+        Compares the vectorized featurizer with panphon's FeatureTable.word_fts.
+
+        :return: List of the inputs whose embeddings differ.
+        """
+        mismatches = []
+        for text, embedding in zip(list_of_texts, self.embed_batch(list_of_texts)):
+            reference = [segment.numeric() for segment in self.ft.word_fts(text)]
+            if not reference:
+                if str(embedding) != 'nan':
+                    mismatches.append(text)
+            elif np.ndim(embedding) == 0 or not np.array_equal(np.mean(reference, axis=0), embedding):
+                mismatches.append(text)
+        return mismatches
+
+# Dynamic INT8 quantization of the linear layers: weights are stored in int8 and activations are
+# quantized on the fly. Only meant for CPU inference.
+def quantize_dynamic_int8(model):
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# Keeps only the first depth encoder layers: the last hidden state of the truncated model is exactly
+# the hidden state number depth of the full model (0 is the embedding layer), at a fraction of the compute.
+def truncate_encoder(model, depth):
+    n_layers = model.config.num_hidden_layers
+    if not 0 <= depth <= n_layers:
+        raise ValueError(f"Depth {depth} out of range: the model has {n_layers} layers.")
+    model.encoder.layer = torch.nn.ModuleList(model.encoder.layer[:depth])
+    model.config.num_hidden_layers = depth
+    return model
+
+# Shared batched inference for the HuggingFace encoders (XPhoneBERT, ClassicBERT).
+# Subclasses must set self.model and self.tokenizer and define how a padded batch is pooled.
+class TransformerEmbeddings(Embeddings):
+    # Number of encoder layers kept by truncate_encoder (None: full model)
+    depth = None
+    quantized = False
+    # Several sentences can share an input row (block-diagonal attention mask + per-segment position ids)
+    supports_packing = True
+    # As the token-id matching of the original ClassicBERT.embed_from_sentence: a single-token target
+    # gives one row per occurrence (averaged later by final_tensor_average), a longer one its first occurrence
+    single_token_occurrences = False
+
+    def _prepare_model(self, quantized=False, depth=None):
+        self.quantized = quantized
+        if depth is not None:
+            self.model = truncate_encoder(self.model, depth)
+            self.depth = depth
+        if quantized:
+            self.model = quantize_dynamic_int8(self.model)
+
+    def _tokenize_batch(self, list_of_texts, max_length=None):
+        # Right padding + attention mask: padded positions are never attended to
+        input_ids = self.tokenizer(list_of_texts, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
+        self._log_truncated(list_of_texts, input_ids, max_length)
+        return input_ids
+
+    def _log_truncated(self, list_of_texts, input_ids, max_length=None):
+        # Only the rows filling the whole maximum length may have been truncated: they are tokenized again in full
+        max_length = max_length or self.tokenizer.model_max_length
+        full_rows = (input_ids['attention_mask'].sum(dim=1) >= max_length).nonzero().flatten().tolist()
+        if len(full_rows) == 0:
+            return
+        lengths = [len(ids) for ids in self.tokenizer([list_of_texts[i] for i in full_rows])['input_ids']]
+        for i, length in zip(full_rows, lengths):
+            if length > max_length:
+                logging.warning(f"Input truncated from {length} to {max_length} tokens: '{list_of_texts[i][:100]}'")
+
+    def _forward(self, input_ids, output_hidden_states=False):
+        with torch.no_grad():
+            return self.model(**input_ids, output_hidden_states=output_hidden_states)
+
+    @staticmethod
+    def _resolve_layers(layers, n_hidden_states):
+        # layers: an int, a list/range of ints or "all". Index 0 is the embedding layer, -1 the last encoder layer.
+        if layers == 'all':
+            return list(range(n_hidden_states))
+        if isinstance(layers, int):
+            layers = [layers]
+        resolved = []
+        for layer in layers:
+            if not -n_hidden_states <= layer < n_hidden_states:
+                raise ValueError(f"Layer {layer} out of range: the model has {n_hidden_states} hidden states.")
+            resolved.append(layer % n_hidden_states)
+        return resolved
+
+    def _pool_hidden_state(self, input_ids, hidden_state):
+        return self._masked_mean(hidden_state, input_ids['attention_mask'])
+
+    @staticmethod
+    def _masked_mean(hidden_states, attention_mask):
+        # Mean over the real tokens only, so that padding does not change the vectors
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        summed = (hidden_states * mask).sum(dim=1)
+        counts = mask.sum(dim=1).clamp(min=1)
+        return summed / counts
+
+    @abstractmethod
+    def _pool_batch(self, input_ids, features):
+        pass
+
+    def embed_batch(self, list_of_texts, layers=None):
+        """
+        Embeds a whole batch of texts with a single padded forward pass.
+
+        :param list_of_texts: List of strings (words or phoneme sequences).
+        :param layers: None for the usual output, otherwise the hidden states to pool (an int, a list, a range or "all").
+        :return: List of tensors of shape (1, hidden_size), one per text, in the same format as embed.
+                 With layers, every element is a dictionary {layer: tensor of shape (1, hidden_size)}.
+        """
+        if len(list_of_texts) == 0:
+            return []
+        input_ids = self._tokenize_batch(list(list_of_texts))
+        features = self._forward(input_ids, output_hidden_states=layers is not None)
+        if layers is None:
+            # A truncated model returns the pooled hidden state of its last kept layer, as embed(layers=[depth]) would
+            if self.depth is not None:
+                features = self._pool_hidden_state(input_ids, features.last_hidden_state)
+            else:
+                features = self._pool_batch(input_ids, features)
+            return [features[i:i + 1] for i in range(features.shape[0])]
+
+        # A single forward pass serves every requested layer
+        layers = self._resolve_layers(layers, len(features.hidden_states))
+        pooled = {layer: self._pool_hidden_state(input_ids, features.hidden_states[layer]) for layer in layers}
+        return [{layer: pooled[layer][i:i + 1] for layer in layers} for i in range(len(list_of_texts))]
+
+    def _encode_with_offsets(self, sentences, max_length=512):
+        # Returns the padded batch and, for every row, the (start, end) character span of each token
+        # (None for special and padding tokens).
+        if self.tokenizer.is_fast:
+            input_ids = self.tokenizer(sentences, return_tensors="pt", padding=True, truncation=True, max_length=max_length,
+                                       return_offsets_mapping=True, return_special_tokens_mask=True)
+            offsets = input_ids.pop('offset_mapping').tolist()
+            special_tokens = input_ids.pop('special_tokens_mask').tolist()
+            offsets = [[None if is_special else tuple(span) for span, is_special in zip(row_offsets, row_special)]
+                       for row_offsets, row_special in zip(offsets, special_tokens)]
+            return input_ids, offsets
+
+        # Slow tokenizers (e.g. XPhoneBERT) have no offset mapping: since their tokens never cross whitespace,
+        # every whitespace-delimited chunk is tokenized on its own and its tokens inherit the chunk's span.
+        rows, offsets = [], []
+        max_content_length = max_length - self.tokenizer.num_special_tokens_to_add()
+        for sentence in sentences:
+            row_ids, row_offsets = [], []
+            for chunk in re.finditer(r'\S+', sentence):
+                chunk_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(chunk.group()))
+                row_ids.extend(chunk_ids)
+                row_offsets.extend([chunk.span()] * len(chunk_ids))
+            row_ids, row_offsets = row_ids[:max_content_length], row_offsets[:max_content_length]
+            rows.append({'input_ids': self.tokenizer.build_inputs_with_special_tokens(row_ids)})
+            offsets.append([None] + row_offsets + [None])
+        input_ids = self.tokenizer.pad(rows, padding=True, return_tensors="pt")
+        offsets = [row_offsets + [None] * (input_ids['input_ids'].shape[1] - len(row_offsets)) for row_offsets in offsets]
+        return input_ids, offsets
+
+    def _target_occurrences(self, row_offsets, sentence, word, first_occurrence=False):
+        # Token positions of every occurrence to embed, one list per occurrence
+        spans = locate_all_words(sentence, word, ignore_case=getattr(self.tokenizer, 'do_lower_case', False))
+        occurrences = [tokens for tokens in (self._tokens_in_span(row_offsets, span) for span in spans) if tokens]
+        if first_occurrence or not self.single_token_occurrences or not occurrences or len(occurrences[0]) > 1:
+            return occurrences[:1]
+        return [tokens for tokens in occurrences if len(tokens) == 1]
+
+    @staticmethod
+    def _tokens_in_span(row_offsets, span):
+        start, end = span
+        return [i for i, token_span in enumerate(row_offsets)
+                if token_span is not None and token_span[0] < end and token_span[1] > start]
+
+    def _first_position_id(self):
+        # RoBERTa-like models (XPhoneBERT) number the positions from padding_idx + 1, BERT from 0
+        padding_idx = getattr(self.model.embeddings, 'padding_idx', None)
+        return 0 if padding_idx is None else padding_idx + 1
+
+    def _pack(self, input_ids, max_length=512):
+        """
+        Packs the rows of a right-padded batch into rows of at most max_length tokens (first fit).
+        Every sentence only attends to itself and keeps the position ids it has on its own.
+
+        :return: Tuple (packed inputs for the model, placement): placement[i] is (packed row, first position) of the sentence i.
+        """
+        lengths = input_ids['attention_mask'].sum(dim=1).tolist()
+        used, placement = [], []
+        for length in lengths:
+            row = next((r for r, used_length in enumerate(used) if used_length + length <= max_length), None)
+            if row is None:
+                used.append(0)
+                row = len(used) - 1
+            placement.append((row, used[row]))
+            used[row] += length
+
+        width = max(used)
+        packed_ids = torch.full((len(used), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(used), width, width), dtype=torch.long)
+        position_ids = torch.zeros((len(used), width), dtype=torch.long)
+        first_position = self._first_position_id()
+        for i, (row, start) in enumerate(placement):
+            end = start + lengths[i]
+            packed_ids[row, start:end] = input_ids['input_ids'][i, :lengths[i]]
+            attention_mask[row, start:end, start:end] = 1
+            position_ids[row, start:end] = torch.arange(first_position, first_position + lengths[i])
+        packed = {'input_ids': packed_ids, 'attention_mask': attention_mask,
+                  'position_ids': position_ids, 'token_type_ids': torch.zeros_like(packed_ids)}
+        return packed, placement
+
+    @staticmethod
+    def _span_mean(hidden_state, row, token_ids):
+        if len(token_ids) == 0:
+            return hidden_state.new_zeros((0, hidden_state.shape[-1]))
+        # Average of the all the embeddings for all the tokens of the word
+        return hidden_state[row, token_ids].mean(dim=0, keepdim=True)
+
+    def _occurrences_mean(self, hidden_state, row, occurrences):
+        # One row per occurrence, (0, hidden_size) when the target was not found
+        if len(occurrences) == 0:
+            return self._span_mean(hidden_state, row, [])
+        return torch.cat([self._span_mean(hidden_state, row, token_ids) for token_ids in occurrences])
+
+    def embed_from_sentence_batch(self, pairs, max_length=512, layers=None, first_occurrence=False):
+        """
+        Contextual embeddings for many (sentence, target word) pairs with one padded forward pass.
+        The target is located through the character offsets of the tokens, so no token-id matching is needed.
+
+        :param pairs: List of (sentence, word) tuples.
+        :param max_length: Maximum number of tokens per sentence.
+        :param layers: None for the last hidden state, otherwise the hidden states to read (an int, a list, a range or "all").
+        :param first_occurrence: If True, only the first occurrence of the target is embedded (see single_token_occurrences).
+        :return: List of tensors of shape (n occurrences, hidden_size): the mean of the target tokens of each occurrence.
+                 If the target is not found (or was truncated away) the tensor has shape (0, hidden_size).
+                 With layers, every element is a dictionary {layer: tensor}.
+        """
+        targets = self.embed_targets_from_sentence_batch([(sentence, [word]) for sentence, word in pairs], max_length, layers,
+                                                         first_occurrence=first_occurrence)
+        return [sentence_targets[0] for sentence_targets in targets]
+
+    def embed_targets_from_sentence_batch(self, items, max_length=512, layers=None, packed=False, first_occurrence=False):
+        """
+        Same as embed_from_sentence_batch, but every sentence is encoded once for all its target words.
+
+        :param items: List of (sentence, [words]) tuples.
+        :param packed: If True, short sentences share input rows of up to max_length tokens (see _pack).
+        :return: For every sentence, the list of the embeddings of its words (see embed_from_sentence_batch).
+        """
+        if len(items) == 0:
+            return []
+        if packed and not self.supports_packing:
+            raise ValueError(f"Sequence packing is not supported by {self.__class__.__name__}.")
+        sentences = [sentence for sentence, _ in items]
+        input_ids, offsets = self._encode_with_offsets(sentences, max_length)
+        if packed:
+            input_ids, placement = self._pack(input_ids, max_length)
+        else:
+            placement = [(i, 0) for i in range(len(items))]
+        features = self._forward(input_ids, output_hidden_states=layers is not None)
+        if layers is not None:
+            layers = self._resolve_layers(layers, len(features.hidden_states))
+
+        embeddings = []
+        for i, (sentence, words) in enumerate(items):
+            row, start = placement[i]
+            sentence_embeddings = []
+            for word in words:
+                occurrences = [[start + token_id for token_id in tokens]
+                               for tokens in self._target_occurrences(offsets[i], sentence, word, first_occurrence)]
+                if len(occurrences) == 0:
+                    logging.error(f"Word '{word}' not found in sentence: '{sentence}'.")
+                if layers is None:
+                    sentence_embeddings.append(self._occurrences_mean(features.last_hidden_state, row, occurrences))
+                else:
+                    sentence_embeddings.append({layer: self._occurrences_mean(features.hidden_states[layer], row, occurrences) for layer in layers})
+            embeddings.append(sentence_embeddings)
+        return embeddings
+
+    def _tokenize_with_offsets(self, sentence):
+        # Token ids and character spans of a whole passage, without special tokens nor truncation
+        if self.tokenizer.is_fast:
+            encoding = self.tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)
+            return encoding['input_ids'], [tuple(span) for span in encoding['offset_mapping']]
+        token_ids, offsets = [], []
+        for chunk in re.finditer(r'\S+', sentence):
+            chunk_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(chunk.group()))
+            token_ids.extend(chunk_ids)
+            offsets.extend([chunk.span()] * len(chunk_ids))
+        return token_ids, offsets
+
+    @staticmethod
+    def _strided_windows(n_tokens, window_length, stride):
+        # (start, end) of overlapping windows covering the passage; the last one ends with the passage
+        if n_tokens <= window_length:
+            return [(0, n_tokens)]
+        starts = list(range(0, n_tokens - window_length, stride)) + [n_tokens - window_length]
+        return [(start, start + window_length) for start in starts]
+
+    def embed_all_occurrences_batch(self, pairs, max_length=512, stride=None, layers=None):
+        """
+        Contextual embeddings averaged over every occurrence of the target word in (possibly long) passages.
+        Passages longer than max_length are read through overlapping windows (stride tokens apart); an occurrence
+        seen by several windows is only read from the one where it has the most context on both sides.
+        Only the windows holding an occurrence are encoded, all in the same padded forward pass.
+
+        :param pairs: List of (passage, word) tuples.
+        :param stride: Distance in tokens between the starts of two windows (half a window by default).
+        :return: Same format as embed_from_sentence_batch.
+        """
+        if len(pairs) == 0:
+            return []
+        window_length = max_length - self.tokenizer.num_special_tokens_to_add()
+        stride = stride if stride is not None else max(1, window_length // 2)
+        # Position of the first passage token inside a row (after [CLS] / <s>)
+        prefix_length = self.tokenizer.build_inputs_with_special_tokens([-1]).index(-1)
+        ignore_case = getattr(self.tokenizer, 'do_lower_case', False)
+
+        rows, occurrences = [], []
+        for passage, word in pairs:
+            token_ids, offsets = self._tokenize_with_offsets(passage)
+            windows = self._strided_windows(len(token_ids), window_length, stride)
+            row_of_window = {}
+            passage_occurrences = []
+            for span in locate_all_words(passage, word, ignore_case):
+                tokens = [i for i, (start, end) in enumerate(offsets) if start < span[1] and end > span[0]]
+                if len(tokens) == 0:
+                    continue
+                # Window where the occurrence is the furthest from both edges
+                candidates = [w for w in windows if w[0] <= tokens[0] and tokens[-1] < w[1]]
+                if len(candidates) == 0:
+                    continue
+                window = max(candidates, key=lambda w: min(tokens[0] - w[0], w[1] - 1 - tokens[-1]))
+                if window not in row_of_window:
+                    row_of_window[window] = len(rows)
+                    rows.append({'input_ids': self.tokenizer.build_inputs_with_special_tokens(token_ids[window[0]:window[1]])})
+                passage_occurrences.append((row_of_window[window], [prefix_length + i - window[0] for i in tokens]))
+            if len(passage_occurrences) == 0:
+                logging.error(f"Word '{word}' not found in sentence: '{passage}'.")
+            occurrences.append(passage_occurrences)
+
+        if len(rows) == 0:
+            # No target anywhere: a minimal row still gives the shapes of the (empty) outputs
+            rows.append({'input_ids': self.tokenizer.build_inputs_with_special_tokens([])})
+        input_ids = self.tokenizer.pad(rows, padding=True, return_tensors="pt")
+        features = self._forward(input_ids, output_hidden_states=layers is not None)
+        hidden_states = {None: features.last_hidden_state}
+        if layers is not None:
+            layers = self._resolve_layers(layers, len(features.hidden_states))
+            hidden_states = {layer: features.hidden_states[layer] for layer in layers}
+
+        embeddings = []
+        for passage_occurrences in occurrences:
+            pooled = {}
+            for layer, hidden_state in hidden_states.items():
+                if len(passage_occurrences) == 0:
+                    pooled[layer] = hidden_state.new_zeros((0, hidden_state.shape[-1]))
+                    continue
+                # Mean over the occurrences of the mean over the tokens of each occurrence
+                pooled[layer] = torch.cat([self._span_mean(hidden_state, row, positions) for row, positions in passage_occurrences]).mean(dim=0, keepdim=True)
+            embeddings.append(pooled[None] if layers is None else pooled)
         return embeddings
 
+    def packing_parity(self, items, max_length=512):
+        """
+        Maximum absolute difference between the packed and the unpacked target embeddings of the same items.
+        """
+        differences = [(a - b).abs().max().item()
+                       for unpacked, packed in zip(self.embed_targets_from_sentence_batch(items, max_length),
+                                                   self.embed_targets_from_sentence_batch(items, max_length, packed=True))
+                       for a, b in zip(unpacked, packed) if a.numel() > 0]
+        return max(differences) if differences else 0.0
+
 # Create a class for XPhoneBERT embeddings that inherits from phonetic_embeddings
-class XPhoneBERT(Embeddings):
+class XPhoneBERT(TransformerEmbeddings):
 
-    def __init__(self) -> None:
+    def __init__(self, quantized=False, depth=None) -> None:
         super().__init__()
         # Load the XPhoneBERT model and tokenizer
         self.model = AutoModel.from_pretrained("vinai/xphonebert-base")
         self.tokenizer = AutoTokenizer.from_pretrained("vinai/xphonebert-base")
+        self._prepare_model(quantized=quantized, depth=depth)
         
-    def embed(self, input_phonemes):
+    def embed(self, input_phonemes, layers=None):
+        # Per-layer vectors (mean of the phoneme tokens) come from the batched path
+        if layers is not None or self.depth is not None:
+            return self.embed_batch([input_phonemes], layers=layers)[0]
         # Tokenize the phonemes and obtain model features
-        input_ids = self.tokenizer(input_phonemes, return_tensors="pt", truncation=True)  
+        input_ids = self._tokenize_batch([input_phonemes])
         features = self.model(**input_ids)
         # Extract the embedding features from the model's output
         features = features.pooler_output
         return features
 
-    def _find_consecutive(self, values, n):
-        n = n-1
-        values.sort()  
-        for i in range(len(values) - n):
-            if values[i] + n == values[i+n]:
-                return values[i:i+(n+1)]
-        return None
+    def _pool_batch(self, input_ids, features):
+        # The pooler reads the first token only; with right padding and the attention mask
+        # its value is the same as in the unpadded, one word at a time, embed
+        return features.pooler_output
 
-    def embed_from_sentence(self, input_phonemes, word, input_text_max_lenght = 512):
-        # Tokenize the phonemes and obtain model features
-        input_ids = self.tokenizer(input_phonemes, return_tensors="pt", truncation=True, max_length=input_text_max_lenght) 
-        word_tokens = self.tokenizer.tokenize(word) 
-        word_ids = torch.tensor(self.tokenizer.convert_tokens_to_ids(word_tokens))
-        # torch.where: tensors must be broadcastable
-        # input_ids_tensor.unsqueeze(0) making it of shape (1, input_ids_tensor_length).
-        # word_ids_tensor.unsqueeze(1) making it of shape (word_ids_length, 1).
-        # now they are broadcastable and can be used in torch.where
-        word_ids = torch.where(input_ids.input_ids.unsqueeze(0) == word_ids.unsqueeze(1))
-        # We sort the values; 
-        word_ids = torch.sort(word_ids[2]).values
-        # I want to extract embeddings only for the full word, which means that all the key phonemes should be consequential to each other
-        word_ids = self._find_consecutive(word_ids, len(word_tokens))
-        features = self.model(**input_ids)
-        # Batch * sequence_length * hidden_size; : means "select all elements along this axis"
-        features = features.last_hidden_state[:, word_ids,]
-        # Average of the all the embeddings for all the phonemes
-        features = torch.mean(features, dim=1)
-        return features
+    def embed_from_sentence(self, input_phonemes, word, input_text_max_lenght = 512, layers=None, all_occurrences=False, stride=None):
+        # all_occurrences: average of every occurrence of word, long passages are read through strided windows
+        if all_occurrences:
+            return self.embed_all_occurrences_batch([(input_phonemes, word)], max_length=input_text_max_lenght, stride=stride, layers=layers)[0]
+        return self.embed_from_sentence_batch([(input_phonemes, word)], max_length=input_text_max_lenght, layers=layers)[0]
 
-class ClassicBERT(Embeddings):
+class ClassicBERT(TransformerEmbeddings):
+    single_token_occurrences = True
 
-    def __init__(self) -> None:
+    def __init__(self, quantized=False, depth=None) -> None:
         super().__init__()
         # Load the classic BERT model and tokenizer
         self.model = AutoModel.from_pretrained("bert-base-uncased")
         self.tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
+        self._prepare_model(quantized=quantized, depth=depth)
 
-    def embed(self, input_text):
-        # Tokenize the input text and obtain model features
-        input_ids = self.tokenizer(input_text, return_tensors="pt")  
+    def embed(self, input_text, layers=None):
+        if layers is not None or self.depth is not None:
+            return self.embed_batch([input_text], layers=layers)[0]
+        # Tokenize the input text and obtain model features (truncated as in embed_batch)
+        input_ids = self._tokenize_batch([input_text])
         features = self.model(**input_ids)
         
         # Check if majority of the tokens are known and not OOV
@@ -201,41 +673,23 @@ class ClassicBERT(Embeddings):
             features = features.last_hidden_state.mean(dim=1)
             # Set features to zeros if the majority of tokens are OOV
         return features
-    
-    def _find_consecutive(self, values, n):
-        n = n-1
-        values.sort()  
-        for i in range(len(values) - n):
-            if values[i] + n == values[i+n]:
-                return values[i:i+(n+1)]
-        return None
 
+    def _pool_hidden_state(self, input_ids, hidden_state):
+        # Same OOV rule as embed, applied row by row and ignoring the padding tokens
+        known_tokens_mask = (input_ids["input_ids"] != self.tokenizer.unk_token_id) & (input_ids["input_ids"] != self.tokenizer.pad_token_id)
+        is_oov = known_tokens_mask.sum(dim=1) <= len(input_ids) // 2
+        pooled = self._masked_mean(hidden_state, input_ids["attention_mask"])
+        pooled[is_oov] = 0.0
+        return pooled
+
+    def _pool_batch(self, input_ids, features):
+        return self._pool_hidden_state(input_ids, features.last_hidden_state)
+    
     # Extract the word embedding of a single word given a sentence (contextual embeddings)
-    def embed_from_sentence(self, sentence, word, max_length = 512):
-        # Tokenize the sentence and obtain model features
-        input_ids = self.tokenizer(sentence, return_tensors="pt", truncation=True, max_length = max_length)  
-        word_tokens = self.tokenizer.tokenize(word)
-        word_ids = self.tokenizer.convert_tokens_to_ids(word_tokens)
-        if len(word_ids) == 1:
-            word_ids = torch.where(input_ids["input_ids"] == word_ids[0])
-            features = self.model(**input_ids)
-            features = features.last_hidden_state[word_ids]
-        else:
-            word_ids = torch.tensor(word_ids)
-            # torch.where: tensors must be broadcastable
-            # input_ids_tensor.unsqueeze(0) making it of shape (1, input_ids_tensor_length).
-            # word_ids_tensor.unsqueeze(1) making it of shape (word_ids_length, 1).
-            # now they are broadcastable and can be used in torch.where
-            word_ids = torch.where(input_ids.input_ids.unsqueeze(0) == word_ids.unsqueeze(1))
-            # We sort the values;
-            word_ids = torch.sort(word_ids[2]).values
-            # I want to extract embeddings only for the full word, which means that all the key phonemes should be consequential to each other
-            word_ids = self._find_consecutive(word_ids, len(word_tokens))
-            features = self.model(**input_ids)
-            features = features.last_hidden_state[:, word_ids,]
-            # Average of the all the embeddings for all the phonemes
-            features = torch.mean(features, dim=1)
-        return features
+    def embed_from_sentence(self, sentence, word, max_length = 512, layers=None, all_occurrences=False, stride=None):
+        if all_occurrences:
+            return self.embed_all_occurrences_batch([(sentence, word)], max_length=max_length, stride=stride, layers=layers)[0]
+        return self.embed_from_sentence_batch([(sentence, word)], max_length=max_length, layers=layers)[0]
 
 
 
@@ -245,178 +699,214 @@ class ClassicBERT(Embeddings):
 # word we want to extract is after the truncation, and this should be avoided.
 # Since XPhoneBert operates on phonemes, it also needs to select only relevant characters rather than phonemes.
 class KeyContextExtractor:
+    """
+    Crops the context sentences that do not fit the model (or all of them with windows_reduction_anyway)
+    around their target word. The sentence is tokenized once with offsets, the target span is found in token
+    space and window tokens are kept on each side of it, so the cropped context always fits the model.
+    Targets that cannot be found are counted in self.counter.
+    """
     def __init__(self, model_max_length, tokenizer, window=10, windows_reduction_anyway=False):
         self.model_max_length = model_max_length
         self.window = window
         self.tokenizer = tokenizer
         self.windows_reduction_anyway = windows_reduction_anyway
+        # Tokens left for the sentence once the special tokens are added
+        self.max_content_length = model_max_length - tokenizer.num_special_tokens_to_add()
+        # Cropped sentences and, among them, the ones whose target word was not found
+        self.cropped = 0
         self.counter = 0
 
-    def _check_sentence_tokens_length(self, sentence):
-        tokenized_length = len(self.tokenizer(sentence)['input_ids'])
-        if tokenized_length > self.model_max_length:
-            return True
-        return False
-        
-    def _solve_split_with_stemming(self, sentence, word):
-        sentence_split = sentence.split(word)
-        for i in range(1, len(word)):
-            if len(sentence_split) >= 2:  # Make sure this is aligned properly with the 'for' loop
-                break
-            shortened_word = word[:-i]
-            sentence_split = sentence.split(shortened_word)
-        
-        # If still no split, return the original word split
-        if len(sentence_split) < 2:  # Ensure this 'if' block is aligned with the 'for' loop
-            sentence_split = sentence.split(word)
-        
-        return sentence_split
+    def _token_offsets(self, sentence):
+        # (start, end) character span of every token of the sentence, special tokens excluded
+        if self.tokenizer.is_fast:
+            offsets = self.tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)['offset_mapping']
+            return [tuple(span) for span in offsets]
+        # Slow tokenizers never cross whitespace: the tokens of a chunk inherit its span (as in TransformerEmbeddings)
+        offsets = []
+        for chunk in re.finditer(r'\S+', sentence):
+            offsets.extend([chunk.span()] * len(self.tokenizer.tokenize(chunk.group())))
+        return offsets
 
     def check_sentence(self, sentence, word):
-        are_tokens_more_than_max = self._check_sentence_tokens_length(sentence)
-        if are_tokens_more_than_max or self.windows_reduction_anyway:  # Indentation looks good here
-            word = word.lower()
-            sentence = sentence.lower()
-            sentence_split = self._solve_split_with_stemming(sentence, word)
-            if len(sentence_split) < 2:
-                self.counter += 1
-                # Handle the case where the word is not found or sentence doesn't split into at least two parts
-                if len(sentence_split) == 0:
-                    sentence_split = ["", ""]
-                    message = f"Word '{word}' not found in sentence: '{sentence}'."
-                    print(message)
-                    logging.error(message)
-                elif len(sentence_split) == 1:
-                    sentence_split = [sentence_split[0], ""]
-                    message = f"Word '{word}' not found in sentence: '{sentence}'."
-                    print(message)
-                    logging.error(message)
-
-            # Apply window reduction logic
-            sentence = (
-                self._window_reduction(sentence_split[0], 'l') + 
-                [word] + 
-                self._window_reduction(sentence_split[1], 'r')
-            )
-            sentence = ' '.join(sentence)
-            print(f"Problematic cases so far: {self.counter}")
-        
-        return sentence    
-
-    def _window_reduction(self, sentence, r_or_l):
-        if r_or_l == 'l':
-            sentence = sentence.split()
-            if self.window > len(sentence):  # Ensure proper indentation of this block under 'if'
-                return sentence
-            sentence = sentence[-self.window:]
-        elif r_or_l == 'r':
-            sentence = sentence.split()
-            if self.window > len(sentence):  # Ensure this block is indented correctly under 'elif'
-                return sentence
-            sentence = sentence[:self.window]
-        return sentence
-
-    
+        offsets = self._token_offsets(sentence)
+        if len(offsets) == 0 or (len(offsets) <= self.max_content_length and not self.windows_reduction_anyway):
+            return sentence
+        self.cropped += 1
+
+        span = locate_word(sentence, word, ignore_case=True)
+        token_ids = [] if span is None else [i for i, (start, end) in enumerate(offsets) if start < span[1] and end > span[0]]
+        if len(token_ids) == 0:
+            self.counter += 1
+            logging.error(f"Word '{word}' not found in sentence: '{sentence}'.")
+            # Beginning of the sentence, as much as the model takes
+            first, last = 0, min(len(offsets), self.max_content_length) - 1
+        else:
+            # The window shrinks if the target and its two windows would not fit the model
+            target_length = token_ids[-1] - token_ids[0] + 1
+            window = min(self.window, max(0, (self.max_content_length - target_length) // 2))
+            first, last = max(0, token_ids[0] - window), min(len(offsets) - 1, token_ids[-1] + window)
+        return sentence[offsets[first][0]:offsets[last][1]]
 
 class Word2Vec(Embeddings):
 
-    def __init__(self) -> None:
+    def __init__(self, store_path=None) -> None:
+        """
+        :param store_path: Store written by scripts/convert_word2vec.py, memory-mapped instead of loading
+                           the full vectors in RAM. If None, the vectors are downloaded/loaded with gensim.
+        """
         super().__init__()
-        self.tokens = gensim.downloader.load('word2vec-google-news-300')
+        self.store_path = store_path
+        if store_path:
+            from embeddings.word2vec_store import load_word2vec_store
+            self.tokens = load_word2vec_store(store_path)
+        else:
+            self.tokens = gensim.downloader.load('word2vec-google-news-300')
 
     def embed(self, input_text):
         if input_text in self.tokens:
             return self.tokens[input_text]
         else:
-            zero_analysis = [0.0] * len(self.tokens['the'])
+            # vector_size, since 'the' may be missing from a restricted store
+            zero_analysis = [0.0] * self.tokens.vector_size
             return zero_analysis
 
+def embed_texts(model, texts):
+    # One batched call when the model supports it
+    if hasattr(model, 'embed_batch'):
+        return model.embed_batch(texts)
+    return [model.embed(text) for text in texts]
+
 class CombinedModels():
-    def __init__(self, model_1, model_2) -> None:
+    """
+    Streaming fusion of two models (e.g. a semantic and a phonetic one): every batch runs on both models
+    concurrently, one thread pool per model, and the concatenated vectors are returned directly
+    instead of going through one pickle per model. As in CombinedModelsFromDict, an input whose
+    embedding is missing, nan or all zeros for either model gives 'EXCLUDED'.
+    """
+    def __init__(self, model_1, model_2, weights=(1.0, 1.0), normalize=False, embed_fn_1=None, embed_fn_2=None) -> None:
+        """
+        :param weights: Multipliers of the two blocks.
+        :param normalize: If True, every block is L2-normalized before weighting.
+        :param embed_fn_1: Function from a list of inputs to their model_1 embeddings (embed_batch/embed by default).
+        :param embed_fn_2: Same for model_2.
+        """
         self.model_1 = model_1
         self.model_2 = model_2
-    
-    def _istensor_check(embeddings):
-        if isinstance(embeddings, torch.tensor):
-            embeddings = embeddings.detach().numpy()
-        return embeddings
+        self.weights = weights
+        self.normalize = normalize
+        self.embed_fn_1 = embed_fn_1 if embed_fn_1 is not None else lambda texts: embed_texts(model_1, texts)
+        self.embed_fn_2 = embed_fn_2 if embed_fn_2 is not None else lambda texts: embed_texts(model_2, texts)
+        self.executor_1 = ThreadPoolExecutor(max_workers=1)
+        self.executor_2 = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def _split_inputs(inputs):
+        # Every input is either the text for both models or a (text_1, text_2) pair (e.g. word and its transcription)
+        texts_1 = [item[0] if isinstance(item, tuple) else item for item in inputs]
+        texts_2 = [item[1] if isinstance(item, tuple) else item for item in inputs]
+        return texts_1, texts_2
+
+    def _submit(self, inputs):
+        texts_1, texts_2 = self._split_inputs(inputs)
+        return self.executor_1.submit(self.embed_fn_1, texts_1), self.executor_2.submit(self.embed_fn_2, texts_2)
+
+    def _fuse(self, future_1, future_2):
+        embs_1, embs_2 = future_1.result(), future_2.result()
+        positions = range(len(embs_1))
+        block_1 = EmbeddingMatrix.from_dict(dict(zip(positions, embs_1)))
+        block_2 = EmbeddingMatrix.from_dict(dict(zip(positions, embs_2)))
+        if self.normalize:
+            block_1, block_2 = block_1.l2_normalized(), block_2.l2_normalized()
+        return list(concatenate_blocks(block_1, block_2, self.weights).to_dict(invalid_value='EXCLUDED').values())
 
     def embed(self, input_text):
-        i_1 = self._istensor_check(self.model_1.embed(input_text))
-        i_2 = self._istensor_check(self.model_2.embed(input_text))
-        final_embs = np.stack[i_1, i_2]
-        return final_embs
-        
+        return self.embed_batch([input_text])[0]
+
+    def embed_batch(self, inputs):
+        return self._fuse(*self._submit(inputs))
+
+    def stream(self, batches):
+        """
+        Yields the fused embeddings of every batch; the next batch is already running on both models
+        while the current one is fused.
+        """
+        pending = None
+        for batch in batches:
+            submitted = self._submit(batch)
+            if pending is not None:
+                yield self._fuse(*pending)
+            pending = submitted
+        if pending is not None:
+            yield self._fuse(*pending)
+
+    def close(self):
+        self.executor_1.shutdown()
+        self.executor_2.shutdown()
+
 class CombinedModelsFromDict:
+    """
+    Concatenates two embeddings dictionaries key by key (dict_1 keys order).
+    Both stores are aligned once into float32 matrices: fusing with other weights or with
+    per-block L2 normalization does not touch the dictionaries again.
+    """
     def __init__(self, dict_1, dict_2) -> None:
         self.dict_1 = dict_1
         self.dict_2 = dict_2
-
-    def _nan_check(self, array, array_comp):
-        if isinstance(array, np.ndarray):
-            return array
-        if isinstance(array, list):
-            return array
-        if np.isnan(array):
-            return np.zeros(len(array_comp))
-        
-    def _zeros_check(self, array):
+        self.matrix_1 = EmbeddingMatrix.from_dict(dict_1)
+        self.matrix_2 = EmbeddingMatrix.from_dict(dict_2, keys=self.matrix_1.keys)
+        self._normalized = None
+
+    def _blocks(self, normalize):
+        if not normalize:
+            return self.matrix_1, self.matrix_2
+        if self._normalized is None:
+            self._normalized = (self.matrix_1.l2_normalized(), self.matrix_2.l2_normalized())
+        return self._normalized
+
+    def fuse(self, weights=(1.0, 1.0), normalize=False):
+        """
+        :param weights: Multipliers of the two blocks.
+        :param normalize: If True, every block is L2-normalized before weighting.
+        :return: EmbeddingMatrix of the concatenated blocks; keys where either embedding is missing,
+                 nan or all zeros are not valid.
         """
-        Check if one of the arrays is a list full of zeros.
+        block_1, block_2 = self._blocks(normalize)
+        return concatenate_blocks(block_1, block_2, weights)
 
-        Parameters:
-        - array (numpy.ndarray): The first array to check.
-        - array_comp (numpy.ndarray): The second array to compare with.
+    def sweep(self, weights_grid, normalize=False):
+        # Yields (weights, fused EmbeddingMatrix) for every pair of weights
+        for weights in weights_grid:
+            yield weights, self.fuse(weights, normalize)
 
-        Returns:
-        - str: "EXCLUDED" if one of the arrays is a list full of zeros, otherwise, returns an empty string.
-        """
-        if isinstance(array, list):
-            array = np.array(array)
-        if np.all(array == 0):
-            return "EXCLUDED"
-        else:
-            return array
-        
-    def combine_models(self):
-        combined_embs = {}
-
-        for element in self.dict_1.keys():
-            array_1 = self.dict_1[element]
-            array_2 = self.dict_2[element]
-            # Check if the elements are PyTorch tensors
-            if isinstance(self.dict_1[element], torch.Tensor):
-                array_1 = self.dict_1[element].detach().numpy()[0]
-            if isinstance(self.dict_2[element], torch.Tensor):
-                array_2 = self.dict_2[element].detach().numpy()[0]
-            
-            array_1 = self._nan_check(array_1, array_2)
-            array_2 = self._nan_check(array_2, array_1)
-
-            array_1 = self._zeros_check(array_1)
-            array_2 = self._zeros_check(array_2)
-
-            if isinstance(array_1, str) or isinstance(array_2, str):
-                combined_embs[element] = 'EXCLUDED'
-                continue
-            
-            # Concatenate along the specified axis
-            combined_embs[element] = np.array(list(array_1) + list(array_2))
-            
-        return combined_embs
+    def combine_models(self, weights=(1.0, 1.0), normalize=False):
+        return self.fuse(weights, normalize).to_dict(invalid_value='EXCLUDED')
     
 class PhoneticModelFactory(ModelFactory):
     @staticmethod
-    def create_model(model_type, p2v_model=None):
+    def create_model(model_type, p2v_model=None, quantized=False, onnx=False, depth=None):
         """
         Factory class responsible for creating instances of phonetic models.
 
         :param model_type: Type of the phonetic model to create.
         :param p2v_model: Pre-trained model for Phoneme2Vec.
+        :param quantized: If True, XPhoneBERT runs with dynamic INT8 quantization (CPU only).
+        :param onnx: If True, XPhoneBERT runs its exported graph through ONNX Runtime.
+        :param depth: If given, XPhoneBERT only keeps its first depth layers.
         :return: Instance of the specified phonetic model.
         """
-        if model_type == 'XPhoneBERT':
-            return XPhoneBERT()
+        if quantized and model_type != 'XPhoneBERT':
+            warnings.warn(f"Quantization is only available for XPhoneBERT; {model_type} runs unquantized.")
+        if onnx and model_type != 'XPhoneBERT':
+            warnings.warn(f"The ONNX backend is only available for XPhoneBERT; {model_type} runs with its default backend.")
+        if depth is not None and model_type != 'XPhoneBERT':
+            warnings.warn(f"Truncated depth is only available for XPhoneBERT; {model_type} runs in full.")
+        if (quantized or depth is not None) and onnx:
+            raise ValueError("Quantization and truncated depth are only available for the PyTorch backend.")
+        if model_type == 'XPhoneBERT' and onnx:
+            from embeddings.onnx_backend import OnnxXPhoneBERT
+            return OnnxXPhoneBERT()
+        elif model_type == 'XPhoneBERT':
+            return XPhoneBERT(quantized=quantized, depth=depth)
         elif model_type == 'ArticulatoryPhonemes':
             return ArticulatoryPhonemes()
         elif model_type == 'Phoneme2Vec':
@@ -426,18 +916,33 @@ class PhoneticModelFactory(ModelFactory):
         
 class SemanticModelFactory(ModelFactory):
     @staticmethod
-    def create_model(model_type, w2v_model):
+    def create_model(model_type, w2v_model, quantized=False, onnx=False, depth=None, w2v_store=None):
         """
         Factory class responsible for creating instances of phonetic models.
 
         :param model_type: Type of the phonetic model to create.
         :param p2v_model: Pre-trained model for Phoneme2Vec.
+        :param quantized: If True, ClassicBert runs with dynamic INT8 quantization (CPU only).
+        :param onnx: If True, ClassicBert runs its exported graph through ONNX Runtime.
+        :param depth: If given, ClassicBert only keeps its first depth layers.
+        :param w2v_store: Memory-mapped store for Word2Vec (see scripts/convert_word2vec.py).
         :return: Instance of the specified phonetic model.
         """
-        if model_type == 'ClassicBert':
-            return ClassicBERT()
+        if quantized and model_type != 'ClassicBert':
+            warnings.warn(f"Quantization is only available for ClassicBert; {model_type} runs unquantized.")
+        if onnx and model_type != 'ClassicBert':
+            warnings.warn(f"The ONNX backend is only available for ClassicBert; {model_type} runs with its default backend.")
+        if depth is not None and model_type != 'ClassicBert':
+            warnings.warn(f"Truncated depth is only available for ClassicBert; {model_type} runs in full.")
+        if (quantized or depth is not None) and onnx:
+            raise ValueError("Quantization and truncated depth are only available for the PyTorch backend.")
+        if model_type == 'ClassicBert' and onnx:
+            from embeddings.onnx_backend import OnnxClassicBERT
+            return OnnxClassicBERT()
+        elif model_type == 'ClassicBert':
+            return ClassicBERT(quantized=quantized, depth=depth)
         elif model_type == 'Word2Vec':
-            return Word2Vec()
+            return Word2Vec(store_path=w2v_store)
         else:
             raise ValueError(f"Unsupported phonetic model type: {model_type}")
         
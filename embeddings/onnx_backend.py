@@ -0,0 +1,191 @@
+import glob
+import os
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from embeddings.embeddings_models import TransformerEmbeddings, ClassicBERT, XPhoneBERT
+
+# HuggingFace checkpoints used by embeddings_models.py
+ONNX_MODELS = {'ClassicBERT': 'bert-base-uncased',
+               'XPhoneBERT': 'vinai/xphonebert-base'}
+
+# Execution provider of the inference sessions
+ONNX_PROVIDER = 'CPUExecutionProvider'
+
+# Exported graphs are cached here, so that every worker process only has to load them
+ONNX_CACHE_DIR = os.environ.get('PSET_ONNX_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pset', 'onnx'))
+
+
+class _EncoderWithPooling(torch.nn.Module):
+    # Only input_ids and attention_mask are graph inputs: token_type_ids are all zeros for single sentences.
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        features = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        return features.last_hidden_state, features.pooler_output
+
+
+class OnnxExporter:
+    def __init__(self, cache_dir=ONNX_CACHE_DIR, opset_version=14) -> None:
+        self.cache_dir = cache_dir
+        self.opset_version = opset_version
+
+    def graph_path(self, model_name):
+        return os.path.join(self.cache_dir, f'{model_name}.onnx')
+
+    def optimized_graph_path(self, model_name, ort_version, provider):
+        # Graph optimizations depend on the onnxruntime release and on the execution provider
+        return os.path.join(self.cache_dir, f'{model_name}.optimized.ort{ort_version}.{provider}.onnx')
+
+    def export(self, model_name, overwrite=False):
+        """
+        Exports the model to ONNX with dynamic batch and sequence axes.
+
+        :param model_name: 'ClassicBERT' or 'XPhoneBERT'.
+        :param overwrite: If False and the graph is already cached, nothing is exported.
+        :return: Path to the exported graph.
+        """
+        path = self.graph_path(model_name)
+        if os.path.exists(path) and not overwrite:
+            return path
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        model = AutoModel.from_pretrained(ONNX_MODELS[model_name])
+        model.eval()
+        tokenizer = AutoTokenizer.from_pretrained(ONNX_MODELS[model_name])
+        dummy_input = tokenizer(['a b c', 'a'], return_tensors='pt', padding=True)
+        dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'},
+                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                        'last_hidden_state': {0: 'batch', 1: 'sequence'},
+                        'pooler_output': {0: 'batch'}}
+
+        # Written to a temporary file first: concurrent workers never read a half-written graph
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.onnx.export(_EncoderWithPooling(model),
+                          (dummy_input['input_ids'], dummy_input['attention_mask']),
+                          tmp_path,
+                          input_names=['input_ids', 'attention_mask'],
+                          output_names=['last_hidden_state', 'pooler_output'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=self.opset_version)
+        os.replace(tmp_path, path)
+        # Stale optimized graphs would not match the new export
+        for optimized_path in glob.glob(os.path.join(glob.escape(self.cache_dir), f'{glob.escape(model_name)}.optimized.*.onnx')):
+            os.remove(optimized_path)
+        return path
+
+
+class OnnxEmbeddings(TransformerEmbeddings):
+    """
+    Runs an exported ClassicBERT/XPhoneBERT graph through onnxruntime (CPU provider).
+    Tokenization, batching, pooling and target-span extraction are shared with the PyTorch models:
+    only the forward pass changes.
+    """
+    # The exported graph only takes a 2D attention mask and no position ids
+    supports_packing = False
+
+    def __init__(self, model_name, cache_dir=ONNX_CACHE_DIR, num_threads=None) -> None:
+        super().__init__()
+        import onnxruntime as ort
+
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(ONNX_MODELS[model_name])
+        exporter = OnnxExporter(cache_dir)
+        optimized_path = exporter.optimized_graph_path(model_name, ort.__version__, ONNX_PROVIDER)
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if os.path.exists(optimized_path):
+            # Graph optimizations were already applied and saved by a previous process
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            path = optimized_path
+            self.session = ort.InferenceSession(path, options, providers=[ONNX_PROVIDER])
+        else:
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # Same scheme as OnnxExporter.export: concurrent workers never load a half-written optimized graph
+            tmp_path = f'{optimized_path}.{os.getpid()}.tmp'
+            options.optimized_model_filepath = tmp_path
+            self.session = ort.InferenceSession(exporter.export(model_name), options, providers=[ONNX_PROVIDER])
+            os.replace(tmp_path, optimized_path)
+
+    @staticmethod
+    def _check_layers(layers):
+        # Only the last hidden state and the pooler output are exported
+        if layers is not None:
+            raise ValueError("Layer selection is not available with the ONNX backend.")
+
+    def _forward(self, input_ids, output_hidden_states=False):
+        feed = {'input_ids': input_ids['input_ids'].numpy().astype(np.int64),
+                'attention_mask': input_ids['attention_mask'].numpy().astype(np.int64)}
+        last_hidden_state, pooler_output = self.session.run(['last_hidden_state', 'pooler_output'], feed)
+        return BaseModelOutputWithPooling(last_hidden_state=torch.from_numpy(last_hidden_state),
+                                          pooler_output=torch.from_numpy(pooler_output))
+
+    def embed_batch(self, list_of_texts, layers=None):
+        self._check_layers(layers)
+        return super().embed_batch(list_of_texts)
+
+    def embed_from_sentence_batch(self, pairs, max_length=512, layers=None, first_occurrence=False):
+        self._check_layers(layers)
+        return super().embed_from_sentence_batch(pairs, max_length=max_length, first_occurrence=first_occurrence)
+
+    def embed_targets_from_sentence_batch(self, items, max_length=512, layers=None, packed=False, first_occurrence=False):
+        self._check_layers(layers)
+        return super().embed_targets_from_sentence_batch(items, max_length=max_length, packed=packed, first_occurrence=first_occurrence)
+
+    def embed_all_occurrences_batch(self, pairs, max_length=512, stride=None, layers=None):
+        self._check_layers(layers)
+        return super().embed_all_occurrences_batch(pairs, max_length=max_length, stride=stride)
+
+    def embed(self, input_text, layers=None):
+        return self.embed_batch([input_text], layers=layers)[0]
+
+    def embed_from_sentence(self, sentence, word, max_length=512, layers=None, all_occurrences=False, stride=None):
+        if all_occurrences:
+            return self.embed_all_occurrences_batch([(sentence, word)], max_length=max_length, stride=stride, layers=layers)[0]
+        return self.embed_from_sentence_batch([(sentence, word)], max_length=max_length, layers=layers)[0]
+
+
+class OnnxClassicBERT(OnnxEmbeddings):
+    # The outputs keep the names of the PyTorch model, which the downstream scripts expect
+    output_name = 'ClassicBERT'
+
+    def __init__(self, cache_dir=ONNX_CACHE_DIR, num_threads=None) -> None:
+        super().__init__('ClassicBERT', cache_dir, num_threads)
+
+    single_token_occurrences = ClassicBERT.single_token_occurrences
+    _pool_hidden_state = ClassicBERT._pool_hidden_state
+    _pool_batch = ClassicBERT._pool_batch
+
+
+class OnnxXPhoneBERT(OnnxEmbeddings):
+    output_name = 'XPhoneBERT'
+
+    def __init__(self, cache_dir=ONNX_CACHE_DIR, num_threads=None) -> None:
+        super().__init__('XPhoneBERT', cache_dir, num_threads)
+
+    _pool_batch = XPhoneBERT._pool_batch
+
+
+def check_parity(torch_model, onnx_model, texts, pairs=None):
+    """
+    Maximum absolute difference between the PyTorch and the ONNX Runtime embeddings.
+
+    :param texts: Inputs for embed_batch.
+    :param pairs: Optional (sentence, word) pairs for embed_from_sentence_batch.
+    :return: Dictionary with the maximum absolute difference of each API.
+    """
+    def max_difference(embs_1, embs_2):
+        differences = [(a - b).abs().max().item() for a, b in zip(embs_1, embs_2) if a.numel() > 0]
+        return max(differences) if differences else 0.0
+
+    parity = {'embed_batch': max_difference(torch_model.embed_batch(texts), onnx_model.embed_batch(texts))}
+    if pairs:
+        parity['embed_from_sentence_batch'] = max_difference(torch_model.embed_from_sentence_batch(pairs),
+                                                             onnx_model.embed_from_sentence_batch(pairs))
+    return parity
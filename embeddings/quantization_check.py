@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from SemPhonTest.CosineSimCalculation import VectorizedCosineAnchorTest
+from SemPhonTest.ScoreComparator import ScoreComparator, ScoreComparatorFour
+
+
+def to_numpy_row(embedding):
+    if isinstance(embedding, torch.Tensor):
+        embedding = embedding.detach().cpu().numpy()
+    return np.asarray(embedding, dtype=np.float64).reshape(-1)
+
+def pset_prevalences(dataset: pd.DataFrame, embs_dict: dict, missing_policy=None):
+    # Same steps and same default missing_policy as scripts/cosine_sim_test.py, without writing anything to disk
+    cosine_anchor_test = VectorizedCosineAnchorTest(embs_dict)
+    if 'd' not in dataset:
+        df_cos_similarities = cosine_anchor_test.calc(dataset, columns=['a', 'a_score', 'b', 'b_score', 'c', 'c_score'],
+                                                      missing_policy=missing_policy)
+        return ScoreComparator(df_cos_similarities).compare_scores()
+    df_cos_similarities = cosine_anchor_test.calc(dataset, columns=['a', 'a_score', 'b', 'b_score',
+                                                                    'c', 'c_score', 'd', 'd_score'],
+                                                  missing_policy=missing_policy)
+    # The quartets with nan or absent cells are dropped, as in cosine_sim_test.compare_scores
+    df_cos_similarities = df_cos_similarities.dropna()
+    df_cos_similarities = df_cos_similarities[df_cos_similarities['d_score'] != "absent"]
+    return ScoreComparatorFour(df_cos_similarities).compare_scores()
+
+
+class QuantizationAccuracyCheck:
+    """
+    Compares a dynamically quantized (INT8) model against its fp32 counterpart on the same inputs.
+    It reports the cosine drift of the embeddings and the change of the PSET prevalences.
+    """
+    def __init__(self, fp32_model, int8_model, batch_size=64) -> None:
+        self.fp32_model = fp32_model
+        self.int8_model = int8_model
+        self.batch_size = batch_size
+
+    def _embed_all(self, model, inputs):
+        embeddings = []
+        for i in range(0, len(inputs), self.batch_size):
+            embeddings.extend(model.embed_batch(inputs[i:i + self.batch_size]))
+        return embeddings
+
+    @staticmethod
+    def _cosine(a, b):
+        a, b = to_numpy_row(a), to_numpy_row(b)
+        norm = np.linalg.norm(a) * np.linalg.norm(b)
+        return float(a @ b / norm) if norm > 0 else 1.0
+
+    def cosine_drift(self, fp32_embs, int8_embs):
+        drift = np.array([1.0 - self._cosine(a, b) for a, b in zip(fp32_embs, int8_embs)])
+        return {'mean': float(drift.mean()),
+                'p50': float(np.percentile(drift, 50)),
+                'p95': float(np.percentile(drift, 95)),
+                'max': float(drift.max())}
+
+    def run(self, dataset: pd.DataFrame, inputs_by_key: dict, missing_policy=None):
+        """
+        :param dataset: PSET quartets/triplets (columns a, b, c[, d]).
+        :param inputs_by_key: Dictionary {dataset word: model input} (e.g. the IPA transcription for XPhoneBERT).
+        :param missing_policy: Words without embeddings, as in scripts/cosine_sim_test.py (see VectorizedCosineAnchorTest.calc).
+        :return: Dictionary with the cosine drift and the fp32/int8 prevalences and their difference.
+        """
+        keys = list(inputs_by_key.keys())
+        inputs = [inputs_by_key[key] for key in keys]
+        fp32_embs = self._embed_all(self.fp32_model, inputs)
+        int8_embs = self._embed_all(self.int8_model, inputs)
+
+        fp32_prevalences = pset_prevalences(dataset, dict(zip(keys, fp32_embs)), missing_policy)
+        int8_prevalences = pset_prevalences(dataset, dict(zip(keys, int8_embs)), missing_policy)
+        return {'cosine_drift': self.cosine_drift(fp32_embs, int8_embs),
+                'fp32_prevalences': [float(p) for p in fp32_prevalences],
+                'int8_prevalences': [float(p) for p in int8_prevalences],
+                'prevalence_delta': [float(q - p) for p, q in zip(fp32_prevalences, int8_prevalences)]}
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pandas as pd
+import gensim.downloader
+from gensim.models import KeyedVectors
+
+# Pretrained vectors used by embeddings_models.Word2Vec
+WORD2VEC_SOURCE = 'word2vec-google-news-300'
+
+
+def dataset_vocabulary(dataset_paths):
+    """
+    Words needed to embed the given PSET csv files (a, b, c[, d] columns).
+    Multi-word items are kept as they are and also split, since extractors embed their words one by one.
+
+    :param dataset_paths: List of csv paths.
+    :return: Sorted list of words.
+    """
+    vocabulary = set()
+    for path in dataset_paths:
+        for item in pd.read_csv(path).values.flatten():
+            if str(item) == 'nan':
+                continue
+            vocabulary.add(str(item))
+            vocabulary.update(str(item).split())
+    return sorted(vocabulary)
+
+
+def restrict_vectors(tokens, vocabulary):
+    """
+    Copy of the KeyedVectors with only the words of vocabulary found in tokens.
+
+    :return: Tuple (restricted KeyedVectors, number of requested words missing from tokens).
+    """
+    words = [word for word in vocabulary if word in tokens]
+    # count=0: a preallocated count would add empty slots (None keys, zero rows) before the added words
+    restricted = KeyedVectors(vector_size=tokens.vector_size, dtype=tokens.vectors.dtype)
+    if words:
+        restricted.add_vectors(words, np.stack([tokens[word] for word in words]))
+    return restricted, len(vocabulary) - len(words)
+
+
+def convert_word2vec(output_path, vocabulary=None, source=WORD2VEC_SOURCE):
+    """
+    One-time conversion of the gensim vectors to a KeyedVectors store that can be memory-mapped
+    (the vectors are saved as a separate .npy file next to output_path).
+
+    :param vocabulary: If given, only these words are kept (restricted store); words missing from the
+                       source are skipped, so they are still embedded as zeros.
+    :return: Tuple (number of stored words, number of requested words missing from the source).
+    """
+    tokens = gensim.downloader.load(source)
+    missing = 0
+    if vocabulary is not None:
+        tokens, missing = restrict_vectors(tokens, vocabulary)
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # sep_limit=0: the vectors always go to their own .npy file, even for a tiny restricted store
+    tokens.save(output_path, sep_limit=0)
+    return len(tokens.index_to_key), missing
+
+
+def load_word2vec_store(path):
+    # Read-only memory map: every process shares the same pages through the page cache
+    return KeyedVectors.load(path, mmap='r')
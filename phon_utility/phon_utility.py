@@ -25,6 +25,21 @@ def string_to_bool_rt(input_str):
     else:
         return input_str
 
+def parse_layers(layers_args):
+    # From the --layers CLI values to a layer selection: ['all'], ['3:7'] (a range) or a list of ints. None if empty.
+    if not layers_args:
+        return None
+    if len(layers_args) == 1 and layers_args[0] == 'all':
+        return 'all'
+    layers = []
+    for value in layers_args:
+        if ':' in value:
+            start, end = value.split(':')
+            layers.extend(range(int(start), int(end)))
+        else:
+            layers.append(int(value))
+    return layers
+
 class checker(ABC):
     def __init__(self) -> None:
          super().__init__()
@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import numpy as np
+from embeddings.embeddings_models import merge_dicts
+from SemPhonTest.NearestNeighbours import CosineNearestNeighbours, IVFFlatIndex, index_path, recall_benchmark
+from phon_utility.save_and_load import PickleLoader
+
+def main(args):
+    embs_dict = merge_dicts(PickleLoader.load(args.embeddings_path))
+    path = args.index_path or index_path(args.embeddings_path)
+
+    if os.path.isdir(path) and not args.rebuild:
+        index = IVFFlatIndex.load(path)
+        print(f'Index loaded from {path}: {len(index)} embeddings, {index.n_lists} lists')
+    else:
+        index = IVFFlatIndex.train(embs_dict, n_lists=args.n_lists)
+        index.save(path)
+        print(f'Index built and saved to {path}: {len(index)} embeddings, {index.n_lists} lists')
+
+    for add_path in args.add_paths:
+        added = merge_dicts(PickleLoader.load(add_path))
+        # The exact search of the benchmark covers the inserted embeddings too
+        embs_dict = {**embs_dict, **added}
+        n_new = index.add_dict(added)
+        print(f'{n_new} new embeddings inserted from {add_path}')
+    if args.add_paths:
+        index.save(path)
+
+    if args.query:
+        for word, neighbours in index.neighbours(args.query, k=args.k, nprobe=args.nprobe).items():
+            print(word + ': ' + ', '.join(f'{neighbour} ({score:.3f})' for neighbour, score in neighbours))
+
+    if args.benchmark:
+        # Words inserted in earlier runs are not in the exact vocabulary
+        words = [word for word in index.keys if word in embs_dict]
+        words = [words[i] for i in np.random.default_rng(0).choice(len(words), min(args.n_queries, len(words)), replace=False)]
+        results = recall_benchmark(index, CosineNearestNeighbours(embs_dict), words, k=args.k, nprobes=args.nprobes)
+        for result in results:
+            print(json.dumps(result))
+        with open(os.path.join(path, 'benchmark.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Approximate nearest-neighbour (IVF-flat) index over an embeddings pickle.')
+    parser.add_argument('--embeddings_path', type=str, required=True, help='Pickle produced by the extraction scripts.')
+    parser.add_argument('--index_path', type=str, default='', help='Index folder (default: next to the embeddings, <embeddings>_ivf).')
+    parser.add_argument('--rebuild', action='store_true', help='Train the index again even if it already exists.')
+    parser.add_argument('--n_lists', type=int, default=None, help='Number of inverted lists (default: 4 * sqrt(number of embeddings)).')
+    parser.add_argument('--add_paths', type=str, nargs='*', default=[], help='Embeddings pickles to insert into the index.')
+    parser.add_argument('--query', type=str, nargs='*', default=[], help='Words whose neighbours are printed.')
+    parser.add_argument('--k', type=int, default=10, help='Number of neighbours.')
+    parser.add_argument('--nprobe', type=int, default=8, help='Lists scored per query.')
+    parser.add_argument('--benchmark', action='store_true', help='recall@k and latency against the exact search, saved in the index folder.')
+    parser.add_argument('--n_queries', type=int, default=200, help='Query words sampled for the benchmark.')
+    parser.add_argument('--nprobes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='nprobe values of the benchmark.')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,17 @@
+import argparse
+from embeddings.word2vec_store import convert_word2vec, dataset_vocabulary, WORD2VEC_SOURCE
+
+def main(args):
+    vocabulary = dataset_vocabulary(args.datasets) if args.datasets else None
+    n_words, missing = convert_word2vec(args.output_path, vocabulary, source=args.source)
+    print(f'{n_words} words saved to {args.output_path}')
+    if vocabulary is not None:
+        print(f'{missing} dataset words are not in {args.source} (embedded as zeros)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the Word2Vec vectors to a memory-mapped KeyedVectors store.')
+    parser.add_argument('--output_path', type=str, required=True, help='Path of the store (e.g. w2v/word2vec.kv).')
+    parser.add_argument('--datasets', type=str, nargs='*', default=[], help='PSET csv files: if given, only their words are stored.')
+    parser.add_argument('--source', type=str, default=WORD2VEC_SOURCE, help='gensim-data name of the vectors.')
+    args = parser.parse_args()
+    main(args)
@@ -1,14 +1,39 @@
 import pandas as pd
 import argparse
-from data.data_source import CosineDatasetUtility
-from SemPhonTest.CosineSimCalculation import CosineSim, CosineAnchorTest
+import os
+from SemPhonTest.CosineSimCalculation import VectorizedCosineAnchorTest, MISSING_POLICIES
+from SemPhonTest.SimilarityMetrics import SIMILARITY_METRICS
 from SemPhonTest.ScoreComparator import (ScoreComparator, 
                                          ScoreDifferenceFinder,
                                          ScoreComparatorFour,
                                          ScoreDifferenceFinderFour)
 from phon_utility.save_and_load import PickleLoader
 
-def main(dataset_path, embeddings_path, output_path):
+def split_layers(extracted_embs):
+    # Multi-layer extractions are saved as {word: {layer: emb}}: they become {layer: {word: emb}}.
+    # Returns None for the usual single-layer embeddings.
+    layered_values = [value for value in extracted_embs.values() if isinstance(value, dict)]
+    if not layered_values:
+        return None
+    layers = sorted(layered_values[0].keys())
+    return {layer: {word: value[layer] if isinstance(value, dict) else value for word, value in extracted_embs.items()}
+            for layer in layers}
+
+def layer_output_path(output_path, layer):
+    root, extension = os.path.splitext(output_path)
+    return f'{root}_layer{layer}{extension}'
+
+def metric_output_path(output_path, metric):
+    root, extension = os.path.splitext(output_path)
+    return f'{root}_{metric}{extension}'
+
+def prevalences_line(scores):
+    # scores: prevalences of one metric, or {metric: prevalences} for a multi-metric sweep
+    if isinstance(scores, dict):
+        return '; '.join(f'{metric}: {prevalences_line(metric_scores)}' for metric, metric_scores in scores.items())
+    return ', '.join(f'{column} prevalence: {score}' for column, score in zip(['b', 'c', 'd'], scores))
+
+def main(dataset_path, embeddings_path, output_path, missing_policy=None, metrics=('cosine',)):
 
     print(f'Calculating cosine similarities... for embeddings:', embeddings_path)
 
@@ -17,15 +42,45 @@ def main(dataset_path, embeddings_path, output_path):
     dataset = pd.read_csv(dataset_path)
     extracted_embs = pl.load(embeddings_path)
 
-    cosine_data_transformer = CosineDatasetUtility()
-    transformed_dataset = cosine_data_transformer.apply(dataset)
+    per_layer_embs = split_layers(extracted_embs)
+    if per_layer_embs is None:
+        return cosine_test(dataset, extracted_embs, output_path, missing_policy, metrics)
+
+    # Every layer is scored in one sweep, from a single load of the embeddings
+    all_scores = {}
+    for layer, layer_embs in per_layer_embs.items():
+        print(f'Layer {layer}')
+        all_scores[layer] = cosine_test(dataset, layer_embs, layer_output_path(output_path, layer), missing_policy, metrics)
+    with open(output_path + '_layers_prevalences.txt', 'w') as f:
+        for layer, scores in all_scores.items():
+            f.write(f'layer {layer}: ' + prevalences_line(scores) + '\n')
+    return all_scores
+
+def cosine_test(dataset, extracted_embs, output_path, missing_policy=None, metrics=('cosine',)):
+    """
+    :param missing_policy: See VectorizedCosineAnchorTest.calc; None keeps the CosineAnchorTest layout ('absent' cells).
+    :param metrics: Names in SimilarityMetrics.SIMILARITY_METRICS. With several metrics, every output file gets the metric name
+        as suffix and the returned value is {metric: prevalences}.
+    """
+    # The embeddings are converted once into an aligned matrix, shared by all the metrics
+    cosine_anchor_test = VectorizedCosineAnchorTest(extracted_embs)
+    missing_report = cosine_anchor_test.missing_embeddings(dataset)
+    if len(missing_report):
+        missing_report.to_csv(output_path + '_missing.csv', index=False)
+        print(f'{len(missing_report)} dataset cells without embeddings (missing_policy={missing_policy}): see {output_path}_missing.csv')
 
-    cosine_sim_calculator = CosineSim()
-    cos_similarities = CosineAnchorTest().calc(transformed_dataset, extracted_embs, cosine_sim_calculator)
+    columns = ['a', 'a_score', 'b', 'b_score', 'c', 'c_score'] + (['d', 'd_score'] if 'd' in dataset else [])
+    all_scores = {}
+    for metric in metrics:
+        # The missing embeddings are resolved once for all the metrics
+        df_similarities = cosine_anchor_test.calc(dataset, columns=columns, missing_policy=missing_policy, metric=metric,
+                                                  missing_report=missing_report)
+        metric_path = output_path if len(metrics) == 1 else metric_output_path(output_path, metric)
+        all_scores[metric] = compare_scores(dataset, df_similarities, metric_path)
+    return all_scores[metrics[0]] if len(metrics) == 1 else all_scores
 
+def compare_scores(dataset, df_cos_similarities, output_path):
     if 'd' not in dataset:
-        df_cos_similarities = CosineAnchorTest()._to_pandas(cos_similarities, columns=['a', 'a_score', 'b', 'b_score',
-                                                                                    'c', 'c_score'])
         df_cos_similarities.to_csv(output_path)
         sc = ScoreComparator(df_cos_similarities)
         sd = ScoreDifferenceFinder(df_cos_similarities)
@@ -37,9 +92,8 @@ def main(dataset_path, embeddings_path, output_path):
             f.write(f'c prevalence: {scores[1]}\n')
             f.write(f'Top differences: {top_differences}\n')
             f.write(f'Bottom differences: {bottom_differences}\n')
+        return scores
     else:
-        df_cos_similarities = CosineAnchorTest()._to_pandas(cos_similarities, columns=['a', 'a_score', 'b', 'b_score',
-                                                                                    'c', 'c_score', 'd', 'd_score'])
         df_cos_similarities.to_csv(output_path)
         nan_rows = df_cos_similarities[df_cos_similarities.isna().any(axis=1)]
         absent_rows = df_cos_similarities[df_cos_similarities['d_score'] == "absent"]
@@ -62,6 +116,7 @@ def main(dataset_path, embeddings_path, output_path):
             f.write(f'Top differences b-d: {top_differences_b_d}\n')
             f.write(f'Bottom differences c: {bottom_differences_c}\n')
             f.write(f'Bottom differences d: {bottom_differences_d}\n')
+    return scores
 
 
 
@@ -70,6 +125,11 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_path', type=str, help='Path to the CSV file containing the dataset.')
     parser.add_argument('--embeddings_path', type=str, help='Path to the file containing the extracted embeddings.')
     parser.add_argument('--output_path', type=str, help='Path to save the output CSV file with cosine similarities.')
+    parser.add_argument('--metrics', type=str, nargs='+', default=['cosine'], choices=sorted(SIMILARITY_METRICS),
+                        help='Similarity metrics: with several metrics the outputs get the metric name as suffix.')
+    parser.add_argument('--missing_policy', type=str, default=None, choices=MISSING_POLICIES,
+                        help='Words without embeddings: skip their quartets, give them a zero vector or fail (default: marked absent, as before). '
+                             'They are listed in <output_path>_missing.csv.')
 
     args = parser.parse_args()
-    main(args.dataset_path, args.embeddings_path, args.output_path)
+    main(args.dataset_path, args.embeddings_path, args.output_path, args.missing_policy, args.metrics)
@@ -0,0 +1,27 @@
+import argparse
+from embeddings.embedding_server import EmbeddingServer, load_models
+from phon_utility.save_and_load import PickleLoader
+
+def main(args):
+    p2v_model = PickleLoader().load(args.p2v_model) if args.p2v_model != '' else None
+    models = load_models(args.models, p2v_model=p2v_model, w2v_store=args.w2v_store or None, quantized=args.quantized)
+    server = EmbeddingServer(args.socket_path, models, max_batch=args.max_batch, max_wait=args.max_wait)
+    print(f'Serving {", ".join(models)} on {args.socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local embedding server: keeps the models loaded across extraction runs.')
+    parser.add_argument('--socket_path', type=str, required=True, help='Path of the UNIX socket.')
+    parser.add_argument('--models', type=str, nargs='+', required=True, help='Models to serve (ClassicBert, Word2Vec, Phoneme2Vec, XPhoneBERT, ArticulatoryPhonemes).')
+    parser.add_argument('--p2v_model', type=str, default='', help='Path to the Phoneme2vec model.')
+    parser.add_argument('--w2v_store', type=str, default='', help='Memory-mapped Word2Vec store (see scripts/convert_word2vec.py).')
+    parser.add_argument('--quantized', action='store_true', help='Run ClassicBert and XPhoneBERT with dynamic INT8 quantization (CPU only).')
+    parser.add_argument('--max_batch', type=int, default=256, help='Maximum number of inputs of a forward pass.')
+    parser.add_argument('--max_wait', type=float, default=0.005, help='Seconds to wait for other requests before running a batch.')
+    args = parser.parse_args()
+    main(args)
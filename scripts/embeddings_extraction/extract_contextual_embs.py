@@ -1,6 +1,9 @@
-from embeddings.embeddings_models import XPhoneBERT, ClassicBERT, KeyContextExtractor
+from embeddings.embeddings_cache import EmbeddingCache, CachedEmbeddings
+from embeddings.embeddings_models import XPhoneBERT, ClassicBERT, KeyContextExtractor, model_output_name
 from ipa_extraction.IpaExtractor import IpaTranscriptionSentence
+from SemPhonTest.BatchProcessing import LengthBucketScheduler
 from phon_utility.save_and_load import PickleLoader, PickleSaver
+from phon_utility.phon_utility import parse_layers
 from tqdm import tqdm
 import torch
 import os
@@ -8,31 +11,67 @@ import glob
 import argparse
 
 
-def get_embeddings(model, w_to_s: dict, embs_path: str, batch_size: int=3, transcriptor = False, window_size:int=20, windows_reduction_anyway=False):
-    # If sentence is longer than the model max length, reduced to n tokens (n is window size)
-    key_context_extractor = KeyContextExtractor(model_max_length=512, tokenizer = model.tokenizer, window=window_size, windows_reduction_anyway=windows_reduction_anyway)
-    batch_count = 0
-    embs_dict = {}
-    for key, item in tqdm(w_to_s.items()):
+def prepare_jobs(key_context_extractor, w_to_s: dict, transcriptor=False, dataset_name=None, crop=True):
+    # Every job is ((dataset_name, word), sentence, target word)
+    jobs = []
+    for key, item in tqdm(w_to_s.items(), desc="Preparing sentences"):
         key_for_context = key
-        batch_count += 1
-        embs_list = []
+        # If transcriptor is not False, it should be a function that takes a list of strings and return it transcribed in IPA alphabet
+        if transcriptor:
+            # key is the central word that we want to extract the context from
+            key_for_context = transcriptor([key])
+            key_for_context = key_for_context[0]
         for s in item:
-            # If transcriptor is not False, it should be a function that takes a list of strings and return it transcribed in IPA alphabet
-            if transcriptor:
-                # key is the central word that we want to extract the context from
-                key_for_context = transcriptor([key])
-                key_for_context = key_for_context[0]
             # s is the sentence in which the key is present. If sentence is longer than the model max length, reduced to n tokens (n is window size)
-            s = key_context_extractor.check_sentence(s, key_for_context)
+            if crop:
+                s = key_context_extractor.check_sentence(s, key_for_context)
             s = s.replace('▁','')
-            embeddings = model.embed_from_sentence(s, key_for_context)
-            embs_list.append(embeddings)
-        embs_dict[key] = embs_list
+            jobs.append(((dataset_name, key), s, key_for_context))
+    return jobs
+
+def save_embedding_batches(w_to_s: dict, scheduled_embs: dict, embs_path: str, batch_size: int, dataset_name=None):
+    # Outputs are put back in the {word: [embs]} structure and saved every batch_size words, as before
+    batch_count = 0
+    embs_dict = {}
+    for key in w_to_s.keys():
+        batch_count += 1
+        embs_dict[key] = scheduled_embs.get((dataset_name, key), [])
         if batch_count % batch_size == 0:
             path = os.path.join(embs_path, 'batch_' + str(batch_count) + '.pkl')
             PickleSaver.save(embs_dict, path)
             embs_dict = {}
+    if embs_dict:
+        path = os.path.join(embs_path, 'batch_' + str(batch_count) + '.pkl')
+        PickleSaver.save(embs_dict, path)
+
+def get_embeddings_for_datasets(model, datasets: dict, batch_size: int=3, transcriptor = False, window_size:int=20, windows_reduction_anyway=False, max_batch_tokens:int=8192, layers=None, packed=False, all_occurrences=False, stride=None):
+    """
+    Contextual extraction for several datasets at once (e.g. anchors, homophones and synonyms):
+    a sentence shared by several words or datasets is encoded only once.
+
+    :param datasets: Dictionary {dataset name: (w_to_s, embs_path)}.
+    """
+    # If sentence is longer than the model max length, reduced to n tokens on each side of the key (n is window size)
+    key_context_extractor = KeyContextExtractor(model_max_length=512, tokenizer = model.tokenizer, window=window_size, windows_reduction_anyway=windows_reduction_anyway)
+    # All the (word, sentence) jobs are collected first, so that the scheduler can deduplicate the sentences and bucket them by tokenized length
+    jobs = []
+    for dataset_name, (w_to_s, _) in datasets.items():
+        # With all_occurrences the passages are not cropped: the model reads them through strided windows
+        jobs.extend(prepare_jobs(key_context_extractor, w_to_s, transcriptor, dataset_name, crop=not all_occurrences))
+
+    if key_context_extractor.cropped:
+        print(f"Cropped sentences: {key_context_extractor.cropped} (target word not found in {key_context_extractor.counter})")
+
+    scheduler = LengthBucketScheduler(model.tokenizer, max_batch_tokens=max_batch_tokens, max_length=512, packed=packed,
+                                      all_occurrences=all_occurrences, stride=stride)
+    scheduled_embs = scheduler.run(model, jobs, layers=layers)
+
+    for dataset_name, (w_to_s, embs_path) in datasets.items():
+        save_embedding_batches(w_to_s, scheduled_embs, embs_path, batch_size, dataset_name)
+
+def get_embeddings(model, w_to_s: dict, embs_path: str, batch_size: int=3, transcriptor = False, window_size:int=20, windows_reduction_anyway=False, max_batch_tokens:int=8192, layers=None):
+    get_embeddings_for_datasets(model, {None: (w_to_s, embs_path)}, batch_size=batch_size, transcriptor=transcriptor, window_size=window_size,
+                                windows_reduction_anyway=windows_reduction_anyway, max_batch_tokens=max_batch_tokens, layers=layers)
 
 def delete_batch_files(embs_path:str):
      #delete the other files in the folder
@@ -73,8 +112,17 @@ def xphone_bert_average(single_emb):
 def final_tensor_average(embs_dict:dict, model:str):
     final_embs = {}
     for key, item in embs_dict.items():
+        # Multi-layer extraction: every sentence gives {layer: emb}, and each layer is averaged on its own
+        if len(item) > 0 and isinstance(item[0], dict):
+            per_layer = {layer: [single_emb[layer] for single_emb in item] for layer in item[0].keys()}
+            layered_embs = final_tensor_average(per_layer, model)
+            final_embs[key] = layered_embs
+            continue
         new_item = []
         for single_emb in item:
+            # The target word was not found in this sentence
+            if single_emb.numel() == 0:
+                continue
             if model == 'ClassicBERT':
                 single_emb = classic_bert_average(single_emb)
                 new_item.append(single_emb)
@@ -84,6 +132,9 @@ def final_tensor_average(embs_dict:dict, model:str):
             else:
                 raise ValueError('Model not supported')
                     
+        if len(new_item) == 0:
+            final_embs[key] = float('nan')
+            continue
         final_embs[key] = torch.mean(torch.stack(new_item), dim=0)
     return final_embs
         
@@ -102,34 +153,69 @@ def save_final_embeddings(embs_path:str, model:str, file_name:str='final'):
 
 
 def main(args):
-        dataset_name = args.dataset_name
-        w_to_s = PickleLoader.load(args.abc_path)
-        embs_path = args.output_folder
+        if len(args.dataset_name) != len(args.abc_path):
+            raise ValueError("Provide one dataset name per abc path.")
+        if args.onnx and args.layers:
+            raise ValueError("--layers is not available with --onnx: the exported graph only returns the last hidden state.")
+        # With several datasets, each one gets its own sub-folder of the output folder
+        if len(args.abc_path) == 1:
+            embs_paths = [args.output_folder]
+        else:
+            embs_paths = [os.path.join(args.output_folder, dataset_name) for dataset_name in args.dataset_name]
+            for embs_path in embs_paths:
+                os.makedirs(embs_path, exist_ok=True)
 
         if args.transcriptor:
             transcriptor = IpaTranscriptionSentence().generate_phonetic_transcriptions
         else: 
             transcriptor = False
         
-        models = {'ClassicBERT': ClassicBERT(), 
-        'XPhoneBERT': XPhoneBERT()}
-        model = models[args.model]
-
-        if args.only_save:
-            save_final_embeddings(embs_path, args.model, file_name=f'{dataset_name}_{model.__class__.__name__}')
+        if args.onnx:
+            from embeddings.onnx_backend import OnnxClassicBERT, OnnxXPhoneBERT
+            models = {'ClassicBERT': OnnxClassicBERT,
+            'XPhoneBERT': OnnxXPhoneBERT}
+            model = models[args.model]()
         else:
-            get_embeddings(model, w_to_s, embs_path, transcriptor=transcriptor, window_size=args.window_size, windows_reduction_anyway=args.windows_reduction_anyway)
-            save_final_embeddings(embs_path, args.model, file_name=f'{dataset_name}_{model.__class__.__name__}')
+            models = {'ClassicBERT': ClassicBERT, 
+            'XPhoneBERT': XPhoneBERT}
+            model = models[args.model](quantized=args.quantized, depth=args.depth)
+        model_name = model_output_name(model)
+        cache = None
+        if args.cache_path:
+            cache = EmbeddingCache(args.cache_path, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+            model = CachedEmbeddings(model, cache)
+
+        if not args.only_save:
+            datasets = {dataset_name: (PickleLoader.load(abc_path), embs_path)
+                        for dataset_name, abc_path, embs_path in zip(args.dataset_name, args.abc_path, embs_paths)}
+            get_embeddings_for_datasets(model, datasets, transcriptor=transcriptor, window_size=args.window_size, windows_reduction_anyway=args.windows_reduction_anyway,
+                                        max_batch_tokens=args.max_batch_tokens, layers=parse_layers(args.layers), packed=args.packed,
+                                        all_occurrences=args.all_occurrences, stride=args.stride)
+            if cache is not None:
+                cache.flush()
+                print(cache)
+        for dataset_name, embs_path in zip(args.dataset_name, embs_paths):
+            save_final_embeddings(embs_path, args.model, file_name=f'{dataset_name}_{model_name}')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--dataset_name', type=str, help='abc file name (e.g., anchors, homophones or synonyms or others).')
-    parser.add_argument('--abc_path', type=str, help='abc path')
+    parser.add_argument('--dataset_name', type=str, nargs='+', help='abc file name(s) (e.g., anchors, homophones or synonyms or others).')
+    parser.add_argument('--abc_path', type=str, nargs='+', help='abc path(s), one per dataset name; sentences shared by several datasets are encoded once')
     parser.add_argument('--transcriptor', type=bool, default=False, help='If True, the words are transcribed in IPA alphabet')
     parser.add_argument('--model', type=str, help='Model to use for extracting embeddings')
     parser.add_argument('--output_folder', type=str, help='Path to the output folder')
-    parser.add_argument('--window_size', type=int, default=20, help='Window size')
+    parser.add_argument('--window_size', type=int, default=20, help='Number of tokens kept on each side of the key word when a sentence is cropped')
     parser.add_argument('--only_save', type=bool, default=False, help='If True, only save the final embeddings')
     parser.add_argument('--windows_reduction_anyway', type=bool, default=False, help='If True, the sentence is reduced to n tokens (n is window size) anyway')
+    parser.add_argument('--quantized', action='store_true', help='Run the model with dynamic INT8 quantization (CPU only)')
+    parser.add_argument('--depth', type=int, default=None, help='Only run the first n encoder layers; the output is the hidden state of layer n')
+    parser.add_argument('--onnx', action='store_true', help='Run the model through ONNX Runtime (CPU only)')
+    parser.add_argument('--layers', type=str, nargs='*', default=[], help='Hidden states to extract in one pass: "all", a range "start:end" or layer indices')
+    parser.add_argument('--cache_path', type=str, default='', help='Path to the persistent embeddings cache (sqlite file), shared across runs')
+    parser.add_argument('--cache_max_gb', type=float, default=2.0, help='Size limit of the embeddings cache; least recently used entries are evicted')
+    parser.add_argument('--packed', action='store_true', help='Pack several short sentences in every input row (block-diagonal attention)')
+    parser.add_argument('--all_occurrences', action='store_true', help='Average every occurrence of the key word; long passages are read through overlapping windows instead of being cropped')
+    parser.add_argument('--stride', type=int, default=None, help='With --all_occurrences, tokens between the starts of two windows (half a window by default)')
+    parser.add_argument('--max_batch_tokens', type=int, default=8192, help='Token budget (rows * longest sentence) of every forward pass')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -1,11 +1,15 @@
 from SemPhonTest.BatchProcessing import TrainingBatch, BatchEmbsExtractor
+from SemPhonTest.ShardedExtraction import ShardedExtractor, build_model, wrap_with_cache, share_model_weights
 from data.datasets.data_source import DatasetFactory
 from phon_utility.save_and_load import BatchConcatenator
 from phon_utility.save_and_load import PickleLoader
-from embeddings.embeddings_models import SemanticModelFactory
-from phon_utility.phon_utility import TrainingDataBatcher, HighestNumberInFolder
+from embeddings.embeddings_cache import EmbeddingCache, CachedEmbeddings
+from embeddings.embedding_server import RemoteEmbeddings
+from embeddings.embeddings_models import SemanticModelFactory, model_output_name
+from phon_utility.phon_utility import TrainingDataBatcher, HighestNumberInFolder, parse_layers
 from tqdm import tqdm
 import argparse
+from functools import partial
 
 def string_to_bool(input_str):
     lower_str = input_str.lower()
@@ -30,14 +34,41 @@ class EmbeddingsProcessor:
         self.training_set, self.length = self.dataset.dataset, len(self.dataset.dataset)
         self.embeddings_path = args.embeddings_path
         self.w2v_model = [PickleLoader().load(args.w2v_model) if args.w2v_model != '' else ''][0]
-        self.model = SemanticModelFactory.create_model(args.model, self.w2v_model)
+        # With an embedding server, the model is not loaded here (and no worker processes are needed)
+        self.workers = args.workers if not args.server_socket else 1
+        if args.onnx and args.layers:
+            raise ValueError("--layers is not available with --onnx: the exported graph only returns the last hidden state.")
+        model_kwargs = {'quantized': args.quantized, 'onnx': args.onnx, 'depth': args.depth, 'w2v_store': args.w2v_store}
+        if self.workers > 1:
+            self.model = None
+            self.model_wrapper = partial(wrap_with_cache, cache_path=args.cache_path, cache_max_gb=args.cache_max_gb)
+            if args.share_weights:
+                # Loaded once here and mapped by all the workers, instead of one copy of the weights per worker
+                self.model_builder = None
+                self.shared_model = share_model_weights(SemanticModelFactory.create_model(args.model, self.w2v_model, **model_kwargs))
+            else:
+                # Every worker process builds its own model
+                self.model_builder = partial(build_model, SemanticModelFactory, args.model, self.w2v_model,
+                                             cache_path=args.cache_path, cache_max_gb=args.cache_max_gb, **model_kwargs)
+                self.shared_model = None
+        elif args.server_socket:
+            self.model = RemoteEmbeddings(args.server_socket, args.model)
+            self.model_name = self.model.remote_class_name
+        else:
+            self.model = SemanticModelFactory.create_model(args.model, self.w2v_model, **model_kwargs)
+            # The output name follows the model class, also when the model sits behind the embeddings cache
+            self.model_name = model_output_name(self.model)
+            if args.cache_path:
+                self.cache = EmbeddingCache(args.cache_path, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+                self.model = CachedEmbeddings(self.model, self.cache)
         self.load_last_batch_bool = string_to_bool(args.load_last_batch)
         self.last_batch = self._calculate_last_batch() if self.load_last_batch_bool else 0
         self.batch_size = int(args.batch_size)
+        self.layers = parse_layers(args.layers)
 
     def _initialize_components(self):
         self.training_batch = TrainingBatch()
-        self.batch_processor = BatchEmbsExtractor(self.model, self.embeddings_path, self.batch_size)
+        self.batch_processor = BatchEmbsExtractor(self.model, self.embeddings_path, self.batch_size, layers=self.layers)
         self.last_batch = self._calculate_last_batch() if self.load_last_batch_bool else 0
         return self.training_batch
     
@@ -66,13 +97,25 @@ class EmbeddingsProcessor:
 
         # Actually extracting embeddings 
 
-        for i in tqdm(range(self.last_batch * self.batch_size, self.length, self.batch_size), desc="Processing batches"):
-            self.training_batch._get_batch(self.batch_size, i, self.training_set)
-            self.training_batch.batch = self._word_processing_for_dict(self.training_batch.batch)
-            self.batch_processor._extract_batch_embeddings_as_dict(i, self.batch_size, self.training_batch.batch)
+        if self.workers > 1:
+            sharded_extractor = ShardedExtractor(self.model_builder, BatchEmbsExtractor, self.training_set, self.embeddings_path,
+                                                 self.batch_size, self.workers, layers=self.layers,
+                                                 prepare_batch=self._word_processing_for_dict,
+                                                 shared_model=self.shared_model, model_wrapper=self.model_wrapper)
+            self.model_name, cache_stats = sharded_extractor.run(self.last_batch, self.length)
+            for stats in cache_stats:
+                print(stats)
+        else:
+            for i in tqdm(range(self.last_batch * self.batch_size, self.length, self.batch_size), desc="Processing batches"):
+                self.training_batch._get_batch(self.batch_size, i, self.training_set)
+                self.training_batch.batch = self._word_processing_for_dict(self.training_batch.batch)
+                self.batch_processor._extract_batch_embeddings_as_dict(i, self.batch_size, self.training_batch.batch)
 
-        BatchConcatenator().concatenate_batches(self.embeddings_path + self.model.__class__.__name__ 
+        BatchConcatenator().concatenate_batches(self.embeddings_path + self.model_name 
         + '_' + args.file_path.split('/')[-1] + '.pkl', self.embeddings_path, self.length // self.batch_size)
+        if hasattr(self, 'cache'):
+            self.cache.flush()
+            print(self.cache)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Embeddings Fast Visualization/Evaluation Script')
@@ -81,9 +124,19 @@ if __name__ == "__main__":
     parser.add_argument('--secondary_phonetic_path', type=str, default='', help='Path to the phonetic dataset file in csv (a,b,c columns)')
     parser.add_argument('--embeddings_path', type=str, required=True, help='Output file for embeddings')
     parser.add_argument('--w2v_model', type=str, default='', help='Path to pre-trained word2vec model (if any)')
+    parser.add_argument('--w2v_store', type=str, default='', help='Memory-mapped Word2Vec store (see scripts/convert_word2vec.py)')
     parser.add_argument('--model', type=str, required=True, help='Semantic model to use')
     parser.add_argument('--load_last_batch', type=str, required=True, help='Load the last batch (true/false)')
     parser.add_argument('--batch_size', type=int, required=True, help='Batch size for processing')
+    parser.add_argument('--quantized', action='store_true', help='Run the model with dynamic INT8 quantization (CPU only, ClassicBert)')
+    parser.add_argument('--cache_path', type=str, default='', help='Path to the persistent embeddings cache (sqlite file), shared across runs')
+    parser.add_argument('--cache_max_gb', type=float, default=2.0, help='Size limit of the embeddings cache; least recently used entries are evicted')
+    parser.add_argument('--server_socket', type=str, default='', help='UNIX socket of a running embedding server (scripts/embedding_server.py) to use instead of loading the model')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (sharded extraction); each one uses cores // workers threads')
+    parser.add_argument('--share_weights', action='store_true', help='With --workers, load the model once and share its weights with all the workers (transformer models, not with --quantized)')
+    parser.add_argument('--layers', type=str, nargs='*', default=[], help='Hidden states to extract in one pass: "all", a range "start:end" or layer indices (ClassicBert)')
+    parser.add_argument('--depth', type=int, default=None, help='Only run the first n encoder layers; the output is the hidden state of layer n (ClassicBert)')
+    parser.add_argument('--onnx', action='store_true', help='Run the model through ONNX Runtime (CPU only, ClassicBert)')
 
     args = parser.parse_args()
     processor = EmbeddingsProcessor(args)
@@ -0,0 +1,48 @@
+import argparse
+from tqdm import tqdm
+from data.data_source import DatasetFactory
+from embeddings.embeddings_models import CombinedModels, SemanticModelFactory, PhoneticModelFactory
+from phon_utility.save_and_load import PickleLoader, PickleSaver
+from SemPhonTest.BatchProcessing import BatchEmbsExtractor, BatchPhoneticEmbsExtractor
+
+def extractor_embed_fn(extractor):
+    # Same per-item handling (multi-word items, missing transcriptions) as the single-model extraction scripts
+    def embed_fn(texts):
+        return list(extractor._embed_batch_as_dict(list(enumerate(texts))).values())
+    return embed_fn
+
+def main(args):
+    # {word: transcription}: the semantic model embeds the word, the phonetic model its transcription
+    dataset = DatasetFactory('SemanticDataset', args.file_path, args.secondary_phonetic_path).create_dataset().dataset
+    p2v_model = PickleLoader().load(args.p2v_model) if args.p2v_model != '' else ''
+    semantic_model = SemanticModelFactory.create_model(args.semantic_model, '', quantized=args.quantized, w2v_store=args.w2v_store)
+    phonetic_model = PhoneticModelFactory.create_model(args.phonetic_model, p2v_model, quantized=args.quantized)
+
+    combined = CombinedModels(semantic_model, phonetic_model, weights=tuple(args.weights), normalize=args.normalize,
+                              embed_fn_1=extractor_embed_fn(BatchEmbsExtractor(semantic_model, '', args.batch_size)),
+                              embed_fn_2=extractor_embed_fn(BatchPhoneticEmbsExtractor(phonetic_model, '', args.batch_size)))
+    words = list(dataset.keys())
+    batches = [[(word, dataset[word]) for word in words[i:i + args.batch_size]] for i in range(0, len(words), args.batch_size)]
+
+    fused_embs = {}
+    for batch, embeddings in tqdm(zip(batches, combined.stream(batches)), total=len(batches), desc="Processing batches"):
+        for (word, _), embedding in zip(batch, embeddings):
+            fused_embs[word] = embedding
+    combined.close()
+    PickleSaver.save(fused_embs, args.output_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract fused semantic+phonetic embeddings in a single pass.')
+    parser.add_argument('--file_path', type=str, required=True, help='Path to the words csv (a,b,c columns)')
+    parser.add_argument('--secondary_phonetic_path', type=str, required=True, help='Path to the aligned transcriptions csv (ARPABET for Phoneme2Vec, IPA otherwise)')
+    parser.add_argument('--semantic_model', type=str, required=True, help='Semantic model (ClassicBert or Word2Vec)')
+    parser.add_argument('--phonetic_model', type=str, required=True, help='Phonetic model (Phoneme2Vec, XPhoneBERT or ArticulatoryPhonemes)')
+    parser.add_argument('--p2v_model', type=str, default='', help='Path to the pretrained phonetic embeddings model')
+    parser.add_argument('--w2v_store', type=str, default='', help='Memory-mapped Word2Vec store (see scripts/convert_word2vec.py)')
+    parser.add_argument('--output_path', type=str, required=True, help='Pickle of the fused embeddings')
+    parser.add_argument('--batch_size', type=int, default=64, help='Batch size for extracting embeddings')
+    parser.add_argument('--weights', type=float, nargs=2, default=[1.0, 1.0], help='Weights of the semantic and phonetic blocks')
+    parser.add_argument('--normalize', action='store_true', help='L2-normalize every block before weighting')
+    parser.add_argument('--quantized', action='store_true', help='Run the transformer models with dynamic INT8 quantization (CPU only)')
+    args = parser.parse_args()
+    main(args)
@@ -1,14 +1,18 @@
 import argparse
 import json
 import time
+from functools import partial
 from tqdm import tqdm
 from data.data_source import DatasetFactory
-from embeddings.embeddings_models import PhoneticModelFactory
+from embeddings.embeddings_cache import EmbeddingCache, CachedEmbeddings
+from embeddings.embedding_server import RemoteEmbeddings
+from embeddings.embeddings_models import PhoneticModelFactory, model_output_name
 from phon_utility.save_and_load import PickleLoader, BatchConcatenator
 from text2phonemesequence import Text2PhonemeSequence
-from phon_utility.phon_utility import HighestNumberInFolder 
+from phon_utility.phon_utility import HighestNumberInFolder, parse_layers
 from SemPhonTest.TranscriptionHandler import TranscriptionEasy
 from SemPhonTest.BatchProcessing import TrainingBatch, BatchPhoneticEmbsExtractor
+from SemPhonTest.ShardedExtraction import ShardedExtractor, build_model, wrap_with_cache, share_model_weights
 
 class PhoneticEmbeddingsProcessor:
     def __init__(self, args): 
@@ -26,9 +30,36 @@ class PhoneticEmbeddingsProcessor:
         self.load_last_batch_bool = args.load_last_batch.lower() == 'true'
         self.last_batch = self._calculate_last_batch() if self.load_last_batch_bool else 0
         self.p2v_model = [PickleLoader().load(args.p2v_model) if args.p2v_model != '' else ''][0]
-        self.phonetic_model = PhoneticModelFactory.create_model(args.phonetic_model, self.p2v_model)  
+        # With an embedding server, the model is not loaded here (and no worker processes are needed)
+        self.workers = args.workers if not args.server_socket else 1
+        if args.onnx and args.layers:
+            raise ValueError("--layers is not available with --onnx: the exported graph only returns the last hidden state.")
+        model_kwargs = {'quantized': args.quantized, 'onnx': args.onnx, 'depth': args.depth}
+        if self.workers > 1:
+            self.phonetic_model = None
+            self.model_wrapper = partial(wrap_with_cache, cache_path=args.cache_path, cache_max_gb=args.cache_max_gb)
+            if args.share_weights:
+                # Loaded once here and mapped by all the workers, instead of one copy of the weights per worker
+                self.model_builder = None
+                self.shared_model = share_model_weights(PhoneticModelFactory.create_model(args.phonetic_model, self.p2v_model, **model_kwargs))
+            else:
+                # Every worker process builds its own model
+                self.model_builder = partial(build_model, PhoneticModelFactory, args.phonetic_model, self.p2v_model,
+                                             cache_path=args.cache_path, cache_max_gb=args.cache_max_gb, **model_kwargs)
+                self.shared_model = None
+        elif args.server_socket:
+            self.phonetic_model = RemoteEmbeddings(args.server_socket, args.phonetic_model)
+            self.model_name = self.phonetic_model.remote_class_name
+        else:
+            self.phonetic_model = PhoneticModelFactory.create_model(args.phonetic_model, self.p2v_model, **model_kwargs)
+            # The output name follows the model class, also when the model sits behind the embeddings cache
+            self.model_name = model_output_name(self.phonetic_model)
+            if args.cache_path:
+                self.cache = EmbeddingCache(args.cache_path, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+                self.phonetic_model = CachedEmbeddings(self.phonetic_model, self.cache)
         self.text2phone_model = self._initialize_text2phone_model()
         self.batch_size = int(args.batch_size)
+        self.layers = parse_layers(args.layers)
 
     def _calculate_last_batch(self):
         batch_calculator = HighestNumberInFolder()
@@ -40,7 +71,7 @@ class PhoneticEmbeddingsProcessor:
     
     def _initialize_components(self):
         self.training_batch = TrainingBatch()
-        self.batch_processor = BatchPhoneticEmbsExtractor(self.phonetic_model, self.embeddings_path, self.batch_size)
+        self.batch_processor = BatchPhoneticEmbsExtractor(self.phonetic_model, self.embeddings_path, self.batch_size, layers=self.layers)
         self.last_batch = self._calculate_last_batch() if self.load_last_batch_bool else 0
         self.transcription_handler = TranscriptionEasy(self.training_set)
         return self.training_batch
@@ -49,13 +80,25 @@ class PhoneticEmbeddingsProcessor:
         return Text2PhonemeSequence(language='en-us', is_cuda=True)
 
     def extract_embeddings(self):
-        for i in tqdm(range(self.last_batch * self.batch_size, self.length, self.batch_size), desc="Processing batches"):
-            self.training_batch._get_batch(self.batch_size, i, self.training_set)
-            self.training_batch.batch = self.transcription_handler._handle_transcription_batch(self.training_batch.batch)
-            self.batch_processor._extract_batch_embeddings_as_dict(i, self.batch_size, self.training_batch.batch)
+        if self.workers > 1:
+            sharded_extractor = ShardedExtractor(self.model_builder, BatchPhoneticEmbsExtractor, self.training_set, self.embeddings_path,
+                                                 self.batch_size, self.workers, layers=self.layers,
+                                                 prepare_batch=self.transcription_handler._handle_transcription_batch,
+                                                 shared_model=self.shared_model, model_wrapper=self.model_wrapper)
+            self.model_name, cache_stats = sharded_extractor.run(self.last_batch, self.length)
+            for stats in cache_stats:
+                print(stats)
+        else:
+            for i in tqdm(range(self.last_batch * self.batch_size, self.length, self.batch_size), desc="Processing batches"):
+                self.training_batch._get_batch(self.batch_size, i, self.training_set)
+                self.training_batch.batch = self.transcription_handler._handle_transcription_batch(self.training_batch.batch)
+                self.batch_processor._extract_batch_embeddings_as_dict(i, self.batch_size, self.training_batch.batch)
 
-        BatchConcatenator().concatenate_batches(self.embeddings_path + self.phonetic_model.__class__.__name__ 
+        BatchConcatenator().concatenate_batches(self.embeddings_path + self.model_name 
         + '_' + args.file_path.split('/')[-1] + '.pkl', self.embeddings_path, self.length // self.batch_size)
+        if hasattr(self, 'cache'):
+            self.cache.flush()
+            print(self.cache)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Phonetic Embeddings Fast Visualization/Evaluation Script')
@@ -67,6 +110,15 @@ if __name__ == "__main__":
     parser.add_argument('--load_last_batch', type=str, required=True, help='Load the last batch of embeddings (true/false)')
     parser.add_argument('--phonetic_model', type=str, required=True, help='Phonetic model to use for extracting embeddings')
     parser.add_argument('--batch_size', type=int, required=True, help='Batch size for extracting embeddings')
+    parser.add_argument('--quantized', action='store_true', help='Run the model with dynamic INT8 quantization (CPU only, XPhoneBERT)')
+    parser.add_argument('--cache_path', type=str, default='', help='Path to the persistent embeddings cache (sqlite file), shared across runs')
+    parser.add_argument('--cache_max_gb', type=float, default=2.0, help='Size limit of the embeddings cache; least recently used entries are evicted')
+    parser.add_argument('--server_socket', type=str, default='', help='UNIX socket of a running embedding server (scripts/embedding_server.py) to use instead of loading the model')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (sharded extraction); each one uses cores // workers threads')
+    parser.add_argument('--share_weights', action='store_true', help='With --workers, load the model once and share its weights with all the workers (transformer models, not with --quantized)')
+    parser.add_argument('--layers', type=str, nargs='*', default=[], help='Hidden states to extract in one pass: "all", a range "start:end" or layer indices (XPhoneBERT)')
+    parser.add_argument('--depth', type=int, default=None, help='Only run the first n encoder layers; the output is the hidden state of layer n (XPhoneBERT)')
+    parser.add_argument('--onnx', action='store_true', help='Run the model through ONNX Runtime (CPU only, XPhoneBERT)')
 
     args = parser.parse_args()
 
@@ -0,0 +1,32 @@
+import argparse
+import json
+from embeddings.embeddings_models import ClassicBERT, XPhoneBERT
+from embeddings.onnx_backend import OnnxExporter, OnnxClassicBERT, OnnxXPhoneBERT, check_parity, ONNX_CACHE_DIR
+
+TORCH_MODELS = {'ClassicBERT': ClassicBERT, 'XPhoneBERT': XPhoneBERT}
+ONNX_EMBEDDINGS = {'ClassicBERT': OnnxClassicBERT, 'XPhoneBERT': OnnxXPhoneBERT}
+
+def main(args):
+    exporter = OnnxExporter(args.cache_dir)
+    for model_name in args.models:
+        path = exporter.export(model_name, overwrite=args.overwrite)
+        print(f'{model_name} exported to {path}')
+
+        if args.parity_words:
+            # Every word is also used as its own one-word context for the contextual path
+            pairs = [(word, word) for word in args.parity_words]
+            parity = check_parity(TORCH_MODELS[model_name](), ONNX_EMBEDDINGS[model_name](args.cache_dir),
+                                  args.parity_words, pairs)
+            print(f'{model_name} parity (max abs difference): {json.dumps(parity)}')
+            if max(parity.values()) > args.tolerance:
+                raise ValueError(f'{model_name}: ONNX embeddings differ from PyTorch by more than {args.tolerance}.')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export ClassicBERT/XPhoneBERT to ONNX and check parity with PyTorch.')
+    parser.add_argument('--models', type=str, nargs='+', default=['ClassicBERT', 'XPhoneBERT'], help='Models to export.')
+    parser.add_argument('--cache_dir', type=str, default=ONNX_CACHE_DIR, help='Folder where the graphs are cached.')
+    parser.add_argument('--overwrite', action='store_true', help='Export again even if the graph is already cached.')
+    parser.add_argument('--parity_words', type=str, nargs='*', default=[], help='Inputs used to compare ONNX and PyTorch embeddings.')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='Maximum accepted absolute difference.')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,20 @@
+import argparse
+from embeddings.embeddings_models import CombinedModelsFromDict, merge_dicts, check_same_keys
+from phon_utility.save_and_load import PickleLoader, PickleSaver
+
+def main(args):
+    semantic = merge_dicts(PickleLoader.load(args.semantic_path))
+    phonetic = merge_dicts(PickleLoader.load(args.phonetic_path))
+    check_same_keys(semantic, phonetic)
+    combined = CombinedModelsFromDict(semantic, phonetic)
+    PickleSaver.save(combined.combine_models(weights=tuple(args.weights), normalize=args.normalize), args.output_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concatenate semantic and phonetic embeddings (e.g. BERT+P2V).')
+    parser.add_argument('--semantic_path', type=str, required=True, help='Pickle of the semantic embeddings.')
+    parser.add_argument('--phonetic_path', type=str, required=True, help='Pickle of the phonetic embeddings.')
+    parser.add_argument('--output_path', type=str, required=True, help='Pickle of the fused embeddings.')
+    parser.add_argument('--weights', type=float, nargs=2, default=[1.0, 1.0], help='Weights of the semantic and phonetic blocks.')
+    parser.add_argument('--normalize', action='store_true', help='L2-normalize every block before weighting.')
+    args = parser.parse_args()
+    main(args)
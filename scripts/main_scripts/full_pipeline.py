@@ -13,11 +13,26 @@ from os import listdir
 from data.datasets.from_csv_to_txt_for_arpabet_transcript import from_csv_to_txt_for_arpabet_transcript
 import warnings
 import argparse
+import os
+import tempfile
+import threading
 
 # We cannot include the arpabet transcriber atm. You should add here your ARPA transcriber
 ARPABET_TRANSCRIBER_PATH = 'text_to_ARPABET/convert_arpabet.py'
 
 
+def start_embedding_server(args):
+    # The models are loaded once here; the extraction subprocesses of every dataset send their inputs to the server
+    from embeddings.embedding_server import EmbeddingServer, load_models
+    from phon_utility.save_and_load import PickleLoader
+    if not args.server_socket:
+        args.server_socket = join(tempfile.gettempdir(), f'pset_embeddings_{os.getpid()}.sock')
+    p2v_model = PickleLoader().load(args.p2v_model) if args.p2v_model else None
+    models = load_models(args.selected_models, p2v_model=p2v_model, w2v_store=args.w2v_store or None, quantized=args.quantized)
+    server = EmbeddingServer(args.server_socket, models)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
 def main():
     # Extract IPA transcriptions
     parser = argparse.ArgumentParser(description='Full test pipeline for phonetic embeddings.')
@@ -30,8 +45,14 @@ def main():
     parser.add_argument('--results_path', type=str, required=True, help='Path to save the results.')
     parser.add_argument('--batch_size', type=str, required=True, help='Batch size for the models.')
     parser.add_argument('--selected_models', type=str, nargs='+', required=True, help='Selected models to run.')
+    parser.add_argument('--quantized', action='store_true', help='Run ClassicBert and XPhoneBERT with dynamic INT8 quantization (CPU only).')
+    parser.add_argument('--w2v_store', type=str, default='', help='Memory-mapped Word2Vec store shared by all the processes (see scripts/convert_word2vec.py).')
+    parser.add_argument('--server_socket', type=str, default='', help='UNIX socket of a running embedding server (scripts/embedding_server.py) used by all the extraction runs.')
+    parser.add_argument('--start_embedding_server', action='store_true', help='Load the selected models once in an embedding server shared by all the datasets.')
     parser.add_argument('--load_ipa_paths', type=str, nargs='+', required=False, help='Paths to IPA already extracted for the selected "grapheme" datasets.')
     parser.add_argument('--load_arpa_paths', type=str, nargs='+', required=False, help='Paths to ARPA already extracted for the selected "grapheme" datasets.')
+    parser.add_argument('--metrics', type=str, nargs='+', default=['cosine'], help='Similarity metrics of the cosine test (see SemPhonTest/SimilarityMetrics.py).')
+    parser.add_argument('--missing_policy', type=str, default=None, choices=['skip', 'zero', 'fail'], help='Cosine test: words without embeddings are skipped, zeroed or make the test fail (default: marked absent).')
     parser.add_argument('--skip_edit_distance_test', action='store_true', help='If enabled, this will skip the distance test.')
     parser.add_argument('--do_not_extract_embeddings', action='store_true', help='If enabled, this will skip the embeddings extraction phase and will go straight to the cosine test.')
     parser.add_argument('--articulatory_embs_do_not_need_format_correction', action='store_true', help='If enabled, this will skip the format correction for the articulatory embeddings.')
@@ -74,14 +95,19 @@ def main():
         pass
     else:
         print('Running full embeddings extraction...')
+        server = start_embedding_server(args) if args.start_embedding_server else None
         for clean_dataset, ipa_dataset, arpa_dataset in zip(args.clean_dataset_paths, ipa_paths, arpa_paths):
             args.ARPABET_words_path = arpa_dataset
             args.IPA_words_path = ipa_dataset
             args.NORMAL_words_path = clean_dataset
             full_embs_extraction(args)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
     
     print('Running cosine similarity test...')
-    full_embeddings = listdir(args.embeddings_path)
+    # Folders next to the embeddings (e.g. nearest-neighbour indexes) are not embeddings
+    full_embeddings = [f for f in listdir(args.embeddings_path) if os.path.isfile(join(args.embeddings_path, f))]
 
     articulatory_embs_paths = [contains_sentence('Articulatory', full_embedding) for full_embedding in full_embeddings]
     articulatory_embs_paths = [join(args.embeddings_path, full_embedding) for art, full_embedding in zip(articulatory_embs_paths, full_embeddings) if art is True]
@@ -104,7 +130,9 @@ def main():
     clean_dataset_paths, full_embeddings = assign_correct_dataset_to_correct_embs(args.clean_dataset_paths, full_embeddings)
     full_cosine_test(clean_dataset_paths,
                     [join(args.embeddings_path, full_embedding) for full_embedding in full_embeddings],  
-                    [join(args.results_path, full_embedding.split('.')[0] + '_cosine.csv') for full_embedding in full_embeddings])
+                    [join(args.results_path, full_embedding.split('.')[0] + '_cosine.csv') for full_embedding in full_embeddings],
+                    args.missing_policy,
+                    args.metrics)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
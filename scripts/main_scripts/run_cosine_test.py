@@ -1,19 +1,23 @@
 import argparse
 from scripts import cosine_sim_test
+from SemPhonTest.CosineSimCalculation import MISSING_POLICIES
+from SemPhonTest.SimilarityMetrics import SIMILARITY_METRICS
 
-def full_cosine_test(dataset_paths, embeddings_paths, output_paths):
+def full_cosine_test(dataset_paths, embeddings_paths, output_paths, missing_policy=None, metrics=('cosine',)):
     for dataset_path, embeddings_path, output_path in zip(dataset_paths, embeddings_paths, output_paths):
-        cosine_sim_test.main(dataset_path, embeddings_path, output_path)
+        cosine_sim_test.main(dataset_path, embeddings_path, output_path, missing_policy, metrics)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculate cosine similarities for multiple datasets.')
     parser.add_argument('--dataset_paths', type=str, nargs='+', help='Paths to the CSV files containing the datasets.')
     parser.add_argument('--embeddings_paths', type=str, nargs='+', help='Paths to the files containing the extracted embeddings.')
     parser.add_argument('--output_paths', type=str, nargs='+', help='Paths to save the output CSV files with cosine similarities.')
+    parser.add_argument('--metrics', type=str, nargs='+', default=['cosine'], choices=sorted(SIMILARITY_METRICS), help='Similarity metrics of the test.')
+    parser.add_argument('--missing_policy', type=str, default=None, choices=MISSING_POLICIES, help='Words without embeddings: skip, zero or fail (default: marked absent).')
 
     args = parser.parse_args()
     
     if len(args.dataset_paths) != len(args.embeddings_paths) or len(args.dataset_paths) != len(args.output_paths):
         parser.error("The number of dataset paths, embeddings paths, and output paths must be the same.")
 
-    full_cosine_test(args.dataset_paths, args.embeddings_paths, args.output_paths)
+    full_cosine_test(args.dataset_paths, args.embeddings_paths, args.output_paths, args.missing_policy, args.metrics)
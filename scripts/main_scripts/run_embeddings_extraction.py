@@ -14,6 +14,9 @@ def parse_arguments():
     parser.add_argument('--p2v_model', type=str, required=True, help='Path to the Phoneme2vec model.')
     parser.add_argument('--batch_size', type=str, required=True, help='Batch size for the models.')
     parser.add_argument('--selected_models', type=str, nargs='+', required=True, help='Selected models to run.')
+    parser.add_argument('--w2v_store', type=str, default='', help='Memory-mapped Word2Vec store shared by all the processes (see scripts/convert_word2vec.py).')
+    parser.add_argument('--server_socket', type=str, default='', help='UNIX socket of a running embedding server: the extraction processes do not load the models.')
+    parser.add_argument('--quantized', action='store_true', help='Run ClassicBert and XPhoneBERT with dynamic INT8 quantization (CPU only).')
 
     return parser.parse_args()
 
@@ -62,6 +65,19 @@ def full_embs_extraction(args):
     }
 
 
+    # Opt-in INT8 inference, only forwarded to the transformer models
+    quantized = getattr(args, 'quantized', False)
+    def quantized_flag(model_name):
+        return ['--quantized'] if quantized and model_name in ('ClassicBert', 'XPhoneBERT') else []
+
+    # The memory-mapped store is only used by Word2Vec
+    w2v_store = getattr(args, 'w2v_store', '')
+    def w2v_store_flag(model_name):
+        return ['--w2v_store', w2v_store] if w2v_store and model_name == 'Word2Vec' else []
+
+    server_socket = getattr(args, 'server_socket', '')
+    server_flag = ['--server_socket', server_socket] if server_socket else []
+
     processes = []
 
     # Running the experiments for semantic models
@@ -76,7 +92,7 @@ def full_embs_extraction(args):
                 '--model', model_name,
                 '--load_last_batch', 'false',
                 '--batch_size', model_args['batch_size']
-            ])
+            ] + quantized_flag(model_name) + w2v_store_flag(model_name) + server_flag)
             processes.append(process)
 
     # Running the experiments for phonetic models
@@ -92,7 +108,7 @@ def full_embs_extraction(args):
                 '--p2v_model', model_args['p2v_model'],
                 '--load_last_batch', 'false',
                 '--batch_size', model_args['batch_size']
-            ])
+            ] + quantized_flag(model_name) + server_flag)
             processes.append(process)
 
     # Wait for all processes to complete
@@ -0,0 +1,27 @@
+import argparse
+import pandas as pd
+from embeddings.embeddings_models import merge_dicts
+from SemPhonTest.NearestNeighbours import CosineNearestNeighbours
+from phon_utility.save_and_load import PickleLoader
+
+def main(args):
+    embs_dict = merge_dicts(PickleLoader.load(args.embeddings_path))
+    nearest_neighbours = CosineNearestNeighbours(embs_dict, block_size=args.block_size)
+    words = args.words or (list(pd.read_csv(args.words_path).iloc[:, 0]) if args.words_path else None)
+    neighbours = nearest_neighbours.neighbours(words, k=args.k)
+
+    rows = [(word, rank, neighbour, score) for word, word_neighbours in neighbours.items()
+            for rank, (neighbour, score) in enumerate(word_neighbours, start=1)]
+    pd.DataFrame(rows, columns=['word', 'rank', 'neighbour', 'score']).to_csv(args.output_path, index=False)
+    print(f'{len(neighbours)} words, top {args.k} neighbours saved to {args.output_path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exact top-k cosine neighbours of words in an embeddings pickle (e.g. phonetic neighbours).')
+    parser.add_argument('--embeddings_path', type=str, required=True, help='Pickle produced by the extraction scripts.')
+    parser.add_argument('--output_path', type=str, required=True, help='Csv with one (word, rank, neighbour, score) line per neighbour.')
+    parser.add_argument('--words', type=str, nargs='*', default=[], help='Query words (default: the whole vocabulary).')
+    parser.add_argument('--words_path', type=str, default='', help='Csv whose first column contains the query words.')
+    parser.add_argument('--k', type=int, default=10, help='Number of neighbours per word.')
+    parser.add_argument('--block_size', type=int, default=256, help='Queries scored together: memory grows with block_size x vocabulary size.')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,41 @@
+import argparse
+import json
+import pandas as pd
+from embeddings.embeddings_models import PhoneticModelFactory, SemanticModelFactory
+from embeddings.quantization_check import QuantizationAccuracyCheck
+from SemPhonTest.CosineSimCalculation import MISSING_POLICIES
+
+def create_model(model_name, quantized):
+    if model_name == 'XPhoneBERT':
+        return PhoneticModelFactory.create_model(model_name, quantized=quantized)
+    return SemanticModelFactory.create_model(model_name, '', quantized=quantized)
+
+def main(args):
+    dataset = pd.read_csv(args.dataset_path)
+    # The model inputs may differ from the dataset words (e.g. IPA transcriptions for XPhoneBERT):
+    # the two csv files must be aligned cell by cell, as in TextToPhoneticDataset
+    words = list(dataset.values.flatten())
+    inputs = list(pd.read_csv(args.inputs_path).values.flatten()) if args.inputs_path else words
+    inputs_by_key = {word: str(model_input) for word, model_input in zip(words, inputs) if str(word) != 'nan'}
+
+    fp32_model = create_model(args.model, quantized=False)
+    int8_model = create_model(args.model, quantized=True)
+    report = QuantizationAccuracyCheck(fp32_model, int8_model, batch_size=args.batch_size).run(dataset, inputs_by_key,
+                                                                                       missing_policy=args.missing_policy)
+
+    print(json.dumps(report, indent=2))
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy check of the dynamic INT8 quantization against fp32.')
+    parser.add_argument('--model', type=str, required=True, help='ClassicBert or XPhoneBERT')
+    parser.add_argument('--dataset_path', type=str, required=True, help='Path to the PSET csv (a, b, c[, d] columns).')
+    parser.add_argument('--inputs_path', type=str, default='', help='Csv aligned with the dataset containing the model inputs (e.g. IPA).')
+    parser.add_argument('--batch_size', type=int, default=64, help='Batch size for the forward passes.')
+    parser.add_argument('--missing_policy', type=str, default=None, choices=MISSING_POLICIES,
+                        help='Words without embeddings, as in scripts/cosine_sim_test.py (default: marked absent).')
+    parser.add_argument('--output_path', type=str, default='', help='Path to save the json report.')
+    args = parser.parse_args()
+    main(args)
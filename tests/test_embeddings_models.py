@@ -0,0 +1,62 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+for module in ('pandas', 'torch', 'transformers', 'gensim', 'panphon', 'datasets', 'nltk'):
+    pytest.importorskip(module)
+
+from embeddings.embeddings_models import locate_all_words, locate_word
+
+
+def test_locate_all_words_only_matches_whole_words():
+    assert locate_all_words('he saw the cat, and he left', 'he') == [(0, 2), (20, 22)]
+    assert locate_all_words('the other cat', 'he') == []
+    assert locate_word('the other cat', 'he') is None
+
+
+def _phoneme2vec(phonemes):
+    from types import SimpleNamespace
+    from gensim.models import KeyedVectors
+    from embeddings.embeddings_models import Phoneme2Vec
+    vectors = KeyedVectors(vector_size=3)
+    vectors.add_vectors(phonemes, np.arange(3 * len(phonemes), dtype=np.float32).reshape(len(phonemes), 3))
+    return Phoneme2Vec(SimpleNamespace(model=SimpleNamespace(wv=vectors))), vectors
+
+
+def test_phoneme2vec_averages_the_phonemes_of_every_word():
+    model, vectors = _phoneme2vec(['K', 'AE1', 'T', 'D', 'AO1', 'G'])
+
+    embedding = model.embed('K AE1 T   D AO1 G')
+
+    np.testing.assert_allclose(embedding, vectors.vectors.mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(model.embed('K AE1 T'), vectors.vectors[:3].mean(axis=0), rtol=1e-6)
+
+
+def _tiny_classic_bert(tmp_path, max_length=16):
+    # Randomly initialized one-layer BERT with a toy vocabulary: no download needed
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from embeddings.embeddings_models import ClassicBERT
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'the', 'cat', 'sat', 'on', 'mat']
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('\n'.join(vocab) + '\n')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=8, num_hidden_layers=1, num_attention_heads=2,
+                        intermediate_size=16, max_position_embeddings=max_length)
+    model = ClassicBERT.__new__(ClassicBERT)
+    model.model = BertModel(config).eval()
+    model.tokenizer = BertTokenizerFast(str(vocab_file), model_max_length=max_length)
+    return model
+
+
+def test_embed_batch_matches_embed_on_truncated_inputs(tmp_path, caplog):
+    import torch
+    model = _tiny_classic_bert(tmp_path)
+    long_text = ' '.join(['the cat sat on the mat'] * 5)
+
+    with caplog.at_level('WARNING'):
+        batched = model.embed_batch([long_text, 'the cat'])
+    with torch.no_grad():
+        single = model.embed(long_text)
+
+    torch.testing.assert_close(batched[0], single, rtol=1e-5, atol=1e-5)
+    assert any('truncated' in record.message for record in caplog.records)
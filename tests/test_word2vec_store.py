@@ -0,0 +1,19 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+KeyedVectors = pytest.importorskip('gensim.models').KeyedVectors
+
+from embeddings.word2vec_store import restrict_vectors
+
+
+def test_restrict_vectors_keeps_only_the_found_words():
+    tokens = KeyedVectors(vector_size=4)
+    tokens.add_vectors(['cat', 'dog', 'bird'], np.arange(12, dtype=np.float32).reshape(3, 4))
+
+    restricted, missing = restrict_vectors(tokens, ['dog', 'cat', 'fish'])
+
+    assert restricted.index_to_key == ['dog', 'cat']
+    assert len(restricted.index_to_key) == len(restricted.vectors) == 2
+    assert all(key is not None for key in restricted.index_to_key)
+    assert missing == 1
+    np.testing.assert_array_equal(restricted['cat'], tokens['cat'])